@@ -22,4 +22,5 @@ from .database import Database
 from .database import DatabaseError
 from .database import DatabaseUninitializedError
 from .database import DatabaseLockError
+from .database import DatabaseAmbiguityError
 from .documents import Documents, Document
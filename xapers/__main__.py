@@ -41,16 +41,37 @@ Commands:
                                       document.
     --source=[<sid>|<file>]             source id, for online retrieval, or
                                         bibtex file path
-    --file[=<file>]                     PDF file to index and archive
+    --file[=<file>]                     PDF file to index and archive (may be
+                                        given multiple times)
     --tags=<tag>[,...]                  initial tags
     --prompt                            prompt for unspecified options
     --view                              view entry after adding
   import <bibtex-file>                Import entries from a bibtex database.
     --tags=<tag>[,...]                  tags to apply to all imported documents
+    --compact                           compact database after import
+    --no-sort                           import entries as they are read,
+                                        rather than sorted by key
+    --batch-size=N                      commit every N entries (default
+                                        1000 with --no-sort)
   delete <search-terms>               Delete documents from database.
     --noprompt                          do not prompt to confirm deletion
   restore                             Restore database from an existing xapers
                                       root directory.
+    --compact                           compact database after restore
+    --shard=N                           only restore documents in shard N
+  reindex                             Reindex all documents from the xapers
+                                      root, applying the indexing policy.
+    --positions=[<field>[,...]]         text fields to index with positions,
+                                        for phrase searches (title, author,
+                                        file; default is 'title,author')
+    --changed                           only reindex docdirs changed since
+                                        the last --changed reindex, and
+                                        delete documents without docdirs
+  compact                             Compact database index, reporting sizes.
+  dedup                               Store identical document files once, in
+                                      a content-addressed blob store.
+  upgrade                             Upgrade database to the current schema
+                                      version (done automatically on write).
 
   tag +<tag>|-<tag> [...] [--] <search-terms>
                                       Add/remove tags.
@@ -58,9 +79,16 @@ Commands:
   search [options] <search-terms>     Search for documents.
     --output=[summary|bibtex|tags|sources|keys|files]
                                         output format (default is 'summary')
-    --sort=[relevance|year]             sort output (default is 'relevance')
+    --sort=[relevance|year|added|modified]
+                                        sort output (default is 'relevance')
     --limit=N                           limit number of results returned
+    --offset=N                          skip first N results
   tags <search-terms>                 Short for \"search --output=tags\".
+    --counts                            output number of documents for each tag
+  facets [options] <search-terms>     Count documents for each tag, source,
+                                      year and author of matching documents.
+    --facet=<facet>[,...]               facets to count (tag, source, sid,
+                                        year, author)
   bibtex <search-terms>               Short for \"search --output=bibtex\".
   view <search-terms>                 View search in curses UI.
   count <search-terms>                Count matches.
@@ -74,7 +102,8 @@ Commands:
                                       stdout.
   source2file <sid>                   Retrieve file for source and write to
                                       stdout.
-  scandoc <file>                      Scan PDF file for source ids.
+  scandoc [options] <file>            Scan PDF file for source ids.
+    --pages=N                           only scan the first N pages
 
   version                             Print version number.
   help [search]                       This usage, or search term help.
@@ -110,8 +139,12 @@ Additionally, the following prefixed terms are understood (where
   year:<since>..<until>        publication year range (also y:)
   year:..<until>
   year:<since>..
+  added:<since>..<until>       date range document was added
+  modified:<since>..<until>    date range document was last modified
 
-Publication years must be four-digit integers.
+Publication years must be four-digit integers.  Dates can be
+YYYY-MM-DD, YYYY-MM, YYYY, or <N>d or <N>w for N days or weeks ago,
+e.g. 'added:1w..' for documents added in the last week.
 
 See the following for more information on search terms:
 
@@ -157,6 +190,7 @@ def main():
     if cmd in ['add', 'a']:
         tags = None
         infile = None
+        extra_files = []
         sid = None
         prompt = False
         view = False
@@ -169,10 +203,12 @@ def main():
             elif '--source=' in sys.argv[argc]:
                 sid = sys.argv[argc].split('=', 1)[1]
             elif '--file' in sys.argv[argc]:
-                if '=' in sys.argv[argc]:
-                    infile = sys.argv[argc].split('=', 1)[1]
-                else:
+                if '=' not in sys.argv[argc]:
                     infile = True
+                elif infile:
+                    extra_files.append(sys.argv[argc].split('=', 1)[1])
+                else:
+                    infile = sys.argv[argc].split('=', 1)[1]
             elif '--tags=' in sys.argv[argc]:
                 tags = sys.argv[argc].split('=', 1)[1].split(',')
             elif '--prompt' in sys.argv[argc]:
@@ -187,7 +223,8 @@ def main():
             query = make_query_string(sys.argv[argc:])
 
         with cli.initdb(writable=True, create=True) as db:
-            docid = cli.add(db, query, infile=infile, sid=sid, tags=tags, prompt=prompt)
+            docid = cli.add(db, query, infile=infile, sid=sid, tags=tags, prompt=prompt,
+                            extra_files=extra_files)
 
         if view and docid:
             nci = import_nci()
@@ -196,6 +233,9 @@ def main():
     ########################################
     elif cmd in ['import', 'i']:
         tags = []
+        compact = False
+        sort = True
+        batch_size = None
 
         argc = 2
         while True:
@@ -205,6 +245,12 @@ def main():
                 tags = sys.argv[argc].split('=', 1)[1].split(',')
             elif '--overwrite' in sys.argv[argc]:
                 overwrite = True
+            elif '--compact' in sys.argv[argc]:
+                compact = True
+            elif '--no-sort' in sys.argv[argc]:
+                sort = False
+            elif '--batch-size=' in sys.argv[argc]:
+                batch_size = int(sys.argv[argc].split('=', 1)[1])
             else:
                 break
             argc += 1
@@ -220,13 +266,14 @@ def main():
             sys.exit(1)
 
         with cli.initdb(writable=True, create=True) as db:
-            cli.importbib(db, bibfile, tags=tags)
+            cli.importbib(db, bibfile, tags=tags, compact=compact,
+                          sort=sort, batch_size=batch_size)
 
     ########################################
     elif cmd in ['update']:
         argc = 2
         query = make_query_string(sys.argv[argc:])
-        with cli.initdb(writable=True) as db:
+        with cli.initdb(writable=True) as db, db.batch():
             for doc in db.search(query):
                 try:
                     print("Updating %s..." % doc.docid, end=' ', file=sys.stderr)
@@ -253,7 +300,7 @@ def main():
 
         query = make_query_string(sys.argv[argc:])
         with cli.initdb(writable=True) as db:
-            count = db.count(query)
+            count = db.count(query, at_least=1)
             if count == 0:
                 print("No documents found for query.", file=sys.stderr)
                 sys.exit(1)
@@ -271,6 +318,7 @@ def main():
         oformat = 'summary'
         sort = 'relevance'
         limit = 0
+        offset = 0
 
         argc = 2
         while True:
@@ -282,6 +330,8 @@ def main():
                 sort = sys.argv[argc].split('=')[1]
             elif '--limit=' in sys.argv[argc]:
                 limit = int(sys.argv[argc].split('=')[1])
+            elif '--offset=' in sys.argv[argc]:
+                offset = int(sys.argv[argc].split('=')[1])
             else:
                 break
             argc += 1
@@ -290,20 +340,58 @@ def main():
             print("Unknown output format.", file=sys.stderr)
             sys.exit(1)
 
-        if sort not in ['relevance', 'year']:
+        if sort not in ['relevance', 'year', 'added', 'modified']:
             print("Unknown sort parameter.", file=sys.stderr)
             sys.exit(1)
 
         query = make_query_string(sys.argv[argc:])
         with cli.initdb() as db:
-            cli.search(db, query, oformat=oformat, sort=sort, limit=limit)
+            cli.search(db, query, oformat=oformat, sort=sort, limit=limit, offset=offset)
 
     ########################################
     elif cmd in ['tags']:
+        counts = False
+
+        argc = 2
+        while True:
+            if argc >= len(sys.argv):
+                break
+            elif '--counts' in sys.argv[argc]:
+                counts = True
+            else:
+                break
+            argc += 1
+
+        query = make_query_string(sys.argv[argc:], require=False)
+        with cli.initdb() as db:
+            if counts:
+                cli.facets(db, query, ['tag'], prefix=False)
+            else:
+                cli.search(db, query, oformat='tags')
+
+    ########################################
+    elif cmd in ['facets']:
+        names = None
+
         argc = 2
+        while True:
+            if argc >= len(sys.argv):
+                break
+            elif '--facet=' in sys.argv[argc]:
+                names = sys.argv[argc].split('=', 1)[1].split(',')
+            else:
+                break
+            argc += 1
+
         query = make_query_string(sys.argv[argc:], require=False)
         with cli.initdb() as db:
-            cli.search(db, query, oformat='tags')
+            for name in names or []:
+                if name not in db.FACETS:
+                    print("Unknown facet '%s'." % name, file=sys.stderr)
+                    sys.exit(1)
+            if not names:
+                names = ['tag', 'source', 'year', 'author']
+            cli.facets(db, query, names)
 
     ########################################
     elif cmd in ['bibtex', 'bib', 'b']:
@@ -351,11 +439,7 @@ def main():
             sys.exit(1)
 
         query = make_query_string(sys.argv[argc:])
-        with cli.initdb(writable=True) as db:
-            for doc in db.search(query):
-                doc.add_tags(add_tags)
-                doc.remove_tags(remove_tags)
-                doc.sync()
+        cli.tag(query, add_tags, remove_tags)
 
     ########################################
     elif cmd in ['dumpterms']:
@@ -379,6 +463,32 @@ def main():
                     for term in doc.term_iter(prefix):
                         print(term)
 
+    ########################################
+    # complete term values, for shell completion
+    elif cmd in ['_complete']:
+        limit = 100
+        argc = 2
+        while True:
+            if argc >= len(sys.argv):
+                break
+            if '--limit=' in sys.argv[argc]:
+                limit = int(sys.argv[argc].split('=')[1])
+            else:
+                break
+            argc += 1
+        try:
+            name = sys.argv[argc]
+        except IndexError:
+            print("Must specify term name (tag, source, sid or key).", file=sys.stderr)
+            sys.exit(1)
+        if name not in ['tag', 'source', 'sid', 'key']:
+            print("Unknown term name '%s'." % name, file=sys.stderr)
+            sys.exit(1)
+        partial = ' '.join(sys.argv[argc+1:])
+        with cli.initdb() as db:
+            for value in db.complete(name, partial, limit or None):
+                print(value)
+
     ########################################
     elif cmd in ['maxid']:
         docid = 0
@@ -391,7 +501,7 @@ def main():
     elif cmd in ['count']:
         query = make_query_string(sys.argv[2:], require=False)
         with cli.initdb() as db:
-            print(db.count(query))
+            print(db.count(query, exact=True))
 
     ########################################
     elif cmd in ['export']:
@@ -402,8 +512,61 @@ def main():
 
     ########################################
     elif cmd in ['restore']:
-        with cli.initdb(writable=True, create=True, force=True) as db:
+        compact = False
+        shard = None
+        for arg in sys.argv[2:]:
+            if arg == '--compact':
+                compact = True
+            elif '--shard=' in arg:
+                shard = int(arg.split('=', 1)[1])
+            else:
+                print("Unknown restore option '%s'." % arg, file=sys.stderr)
+                sys.exit(1)
+        if compact and shard is not None:
+            print("--compact can not be used with --shard; compact once all shards are restored.", file=sys.stderr)
+            sys.exit(1)
+        with cli.initdb(writable=True, create=True, force=True, shard=shard) as db:
             db.restore(log=True)
+            if compact:
+                cli.compactdb(db)
+
+    ########################################
+    elif cmd in ['reindex']:
+        positions = None
+        changed = False
+        for arg in sys.argv[2:]:
+            if '--positions=' in arg:
+                positions = [f for f in arg.split('=', 1)[1].split(',') if f]
+            elif arg == '--changed':
+                changed = True
+            else:
+                print("Unknown reindex option '%s'." % arg, file=sys.stderr)
+                sys.exit(1)
+        with cli.initdb(writable=True) as db:
+            if positions is not None:
+                for field in positions:
+                    if field not in db.INDEX_FIELDS:
+                        print("Unknown index field '%s'." % field, file=sys.stderr)
+                        sys.exit(1)
+                db.set_positions(positions)
+            count, removed = db.reindex(log=True, changed=changed)
+            print("%d documents reindexed, %d deleted." % (count, removed), file=sys.stderr)
+
+    ########################################
+    elif cmd in ['dedup']:
+        with cli.initdb(writable=True) as db:
+            cli.dedup(db)
+
+    ########################################
+    elif cmd in ['compact']:
+        with cli.initdb(writable=True) as db:
+            cli.compactdb(db)
+
+    ########################################
+    elif cmd in ['upgrade']:
+        # initdb upgrades writable databases
+        with cli.initdb(writable=True) as db:
+            print("Database version %d." % db.get_version(), file=sys.stderr)
 
     ########################################
     elif cmd in ['sources']:
@@ -493,14 +656,25 @@ def main():
 
     ########################################
     elif cmd in ['scandoc', 'sd']:
+        pages = None
+        argc = 2
+        while True:
+            if argc >= len(sys.argv):
+                break
+            elif '--pages=' in sys.argv[argc]:
+                pages = int(sys.argv[argc].split('=', 1)[1])
+            else:
+                break
+            argc += 1
+
         try:
-            infile = sys.argv[2]
+            infile = sys.argv[argc]
         except IndexError:
             print("Must specify document to scan.", file=sys.stderr)
             sys.exit(1)
 
         try:
-            items = Sources().scan_file(infile)
+            items = Sources().scan_file(infile, pages=pages)
         except ParseError as e:
             print("Parse error: %s" % e, file=sys.stderr)
             print("Is file '%s' a PDF?" % infile, file=sys.stderr)
@@ -23,12 +23,14 @@ import sys
 import io
 import re
 import json
+import collections
 import pybtex
 from pybtex.bibtex.utils import split_name_list
 from pybtex.database import Entry, Person
 from pybtex.database.input import bibtex as inparser
 from pybtex.database.output import bibtex as outparser
 from pybtex.scanner import TokenRequired
+from pybtex.exceptions import PybtexError
 
 
 def clean_bib_string(string):
@@ -93,6 +95,55 @@ class Bibtex():
 
 ##################################################
 
+# iterate over the text of the top-level commands (entries, @string,
+# @preamble, etc.) in a bibtex stream, reading a line at a time.
+# commands start with an '@' at the beginning of a line, outside of
+# any braces.
+def _split_commands(stream):
+    lines = []
+    depth = 0
+    for line in stream:
+        if depth <= 0 and line.lstrip().startswith('@'):
+            if lines:
+                yield ''.join(lines)
+            lines = []
+            depth = 0
+        if lines or line.lstrip().startswith('@'):
+            lines.append(line)
+            depth += line.count('{') - line.count('}')
+    if lines:
+        yield ''.join(lines)
+
+def stream_bibtex(bibfile):
+    """Iterate over the entries of a bibtex file, as Bibentry objects.
+
+    Unlike Bibtex, the file is read and parsed an entry at a time, so
+    memory use is bounded by the size of the largest entry, and
+    entries are available as soon as they are read.  @string macros
+    apply to the entries that follow them.  Duplicate keys are not
+    detected.  `bibfile` may be a path or a text stream.
+
+    """
+    if isinstance(bibfile, str):
+        with open(bibfile, 'r', encoding='utf-8') as f:
+            yield from stream_bibtex(f)
+        return
+
+    macros = inparser.month_names
+    for text in _split_commands(bibfile):
+        # a new parser for each command, so that parsed entries
+        # aren't accumulated, with the macros defined so far
+        parser = inparser.Parser(encoding='utf-8', macros=macros)
+        try:
+            bibdata = parser.parse_string(text)
+        except PybtexError as e:
+            raise BibtexError(str(e))
+        macros = parser.macros
+        for key, entry in bibdata.entries.items():
+            yield Bibentry(key, entry)
+
+##################################################
+
 class Bibentry():
     """Represents an individual entry in a bibtex database.
 
@@ -100,29 +151,37 @@ class Bibentry():
     def __init__(self, key, entry):
         self.key = key
         self.entry = entry
+        # cleaned authors and fields, computed on first use
+        self._authors = None
+        self._fields = None
 
     def get_authors(self):
         """Return a list of authors."""
-        authors = []
-        if 'author' in self.entry.persons:
-            for p in self.entry.persons['author']:
-                authors.append(clean_bib_string(str(p)))
-        return authors
+        if self._authors is None:
+            authors = []
+            if 'author' in self.entry.persons:
+                for p in self.entry.persons['author']:
+                    authors.append(clean_bib_string(str(p)))
+            self._authors = authors
+        return list(self._authors)
 
     def get_fields(self):
         """Return a dict of non-author fields."""
-        bibfields = self.entry.fields
-        # entry.fields is actually already a dict, but we want to
-        # clean the strings first
-        fields = {}
-        for field in bibfields:
-            # Treat all keys as lowercase
-            fields[field.lower()] = str(clean_bib_string(bibfields[field]))
-        return fields
+        if self._fields is None:
+            bibfields = self.entry.fields
+            # entry.fields is actually already a dict, but we want to
+            # clean the strings first
+            fields = {}
+            for field in bibfields:
+                # Treat all keys as lowercase
+                fields[field.lower()] = str(clean_bib_string(bibfields[field]))
+            self._fields = fields
+        return dict(self._fields)
 
     def set_file(self, path):
         # FIXME: what's the REAL proper format for this
         self.entry.fields['file'] = ':%s:%s' % (path, 'pdf')
+        self._fields = None
 
     def get_file(self):
         """Returns file path if file field exists.
@@ -157,11 +216,40 @@ class Bibentry():
 
     def to_file(self, path):
         """Write entry bibtex to file."""
+        _bibentry_cache.pop(os.path.abspath(path), None)
         writer = outparser.Writer(encoding='utf-8')
         writer.write_file(self._entry2db(), path)
 
 ##################################################
 
+# process-wide cache of the parsed entries of bibtex files, as
+# ((mtime, size), Bibentry) tuples by path, least recently used first
+_bibentry_cache = collections.OrderedDict()
+BIBENTRY_CACHE_SIZE = 1024
+
+def load_bibentry(path):
+    """Return the (first) Bibentry of a bibtex file.
+
+    Parsed entries are cached, and the file is only parsed again if
+    its mtime or size have changed.  Cached entries are shared, and
+    should only be modified to be written back to their file.
+
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _bibentry_cache.get(path)
+    if cached and cached[0] == stamp:
+        _bibentry_cache.move_to_end(path)
+        return cached[1]
+    bibentry = Bibtex(path)[0]
+    _bibentry_cache[path] = (stamp, bibentry)
+    while len(_bibentry_cache) > BIBENTRY_CACHE_SIZE:
+        _bibentry_cache.popitem(last=False)
+    return bibentry
+
+##################################################
+
 def data2bib(data, key, type='article'):
     """Convert a python dict into a Bibentry object."""
 
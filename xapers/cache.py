@@ -0,0 +1,198 @@
+"""
+This file is part of xapers.
+
+Xapers is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Xapers is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with xapers.  If not, see <https://www.gnu.org/licenses/>.
+
+Copyright 2012-2017
+Jameson Rollins <jrollins@finestructure.net>
+"""
+
+import os
+import zlib
+import json
+import hashlib
+import tempfile
+import threading
+
+##################################################
+
+class SearchCache():
+    """On-disk cache of search results.
+
+    Each entry is a json file in the cache directory `path`, named for
+    a hash of its key and tagged with the database `revision` it was
+    computed against.  Entries from any other revision are discarded
+    when read.  At most `size` entries are kept, and the least
+    recently used entries are removed first.
+
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def _entry_path(self, key):
+        key = json.dumps(key, separators=(',', ':'), ensure_ascii=False)
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, name)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, key, revision):
+        """Return value cached for key at revision, or None."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('revision') != revision:
+            self._remove(path)
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['value']
+
+    def set(self, key, revision, value):
+        """Cache json-serialisable value for key at revision."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # write to a temp file and rename, so that concurrent
+            # readers never see partial entries
+            fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'revision': revision, 'value': value}, f,
+                          separators=(',', ':'))
+            os.replace(tmp, self._entry_path(key))
+        except OSError:
+            # the cache is only an optimization
+            return
+        self._prune()
+
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+        if len(entries) <= self.size:
+            return
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.size]:
+            self._remove(path)
+
+    def clear(self):
+        """Remove all cache entries."""
+        try:
+            for entry in os.scandir(self.path):
+                self._remove(entry.path)
+        except OSError:
+            pass
+
+##################################################
+
+class TextCache():
+    """On-disk cache of text extracted from document files.
+
+    Each entry is a zlib-compressed file in the cache directory
+    `path`, named for the content hash of the parsed file and the
+    parser that extracted the text, so that entries never need to be
+    invalidated.  The cache is kept under `size` bytes, and the least
+    recently used entries are removed first.  Safe to use from
+    multiple threads.
+
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        # running total of bytes in the cache, found on first write
+        self._total = None
+
+    def _entry_path(self, digest, parser):
+        return os.path.join(self.path, '%s-%s' % (digest, parser))
+
+    def get(self, digest, parser):
+        """Return text cached for file digest and parser, or None."""
+        path = self._entry_path(digest, parser)
+        try:
+            with open(path, 'rb') as f:
+                text = zlib.decompress(f.read()).decode()
+        except (OSError, zlib.error, UnicodeDecodeError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return text
+
+    def set(self, digest, parser, text):
+        """Cache text for file digest and parser."""
+        data = zlib.compress(text.encode())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._entry_path(digest, parser))
+        except OSError:
+            # the cache is only an optimization
+            return
+        with self._lock:
+            if self._total is None:
+                self._total = self._prune()
+            else:
+                self._total += len(data)
+                if self._total > self.size:
+                    self._total = self._prune()
+
+    def _prune(self):
+        # remove least recently used entries until the cache is
+        # under 90% of its size, so that it isn't pruned on every
+        # write once full.  returns the resulting cache size.
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total <= self.size:
+            return total
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= 0.9 * self.size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        return total
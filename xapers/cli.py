@@ -20,22 +20,35 @@ Jameson Rollins <jrollins@finestructure.net>
 
 import os
 import sys
+import time
 import shutil
 import readline
+import collections
 
+from . import util
 from . import database
 from .documents import Document
 from .source import Sources, SourceError
-from .parser import ParseError
-from .bibtex import Bibtex, BibtexError
+from .parser import ParseError, ParsePool, ParsedFile
+from .bibtex import BibtexError, stream_bibtex
 
 ############################################################
 
-def initdb(writable=False, create=False, force=False):
+def initdb(writable=False, create=False, force=False, lock_error=False, shard=None):
     xroot = os.getenv('XAPERS_ROOT',
                       os.path.expanduser(os.path.join('~','.xapers','docs')))
+    # seconds to wait for the database write lock
+    lock_timeout = float(os.getenv('XAPERS_LOCK_TIMEOUT', 5))
+    # number of shards for new databases
+    shards = int(os.getenv('XAPERS_SHARDS', 1))
     try:
-        return database.Database(xroot, writable=writable, create=create, force=force)
+        db = database.Database(xroot, writable=writable, create=create, force=force,
+                               lock_timeout=lock_timeout, shards=shards, shard=shard)
+    except database.DatabaseLockError as e:
+        if lock_error:
+            raise
+        print(e, file=sys.stderr)
+        sys.exit(1)
     except database.DatabaseUninitializedError as e:
         print(e, file=sys.stderr)
         print("Import a document to initialize.", file=sys.stderr)
@@ -47,20 +60,45 @@ def initdb(writable=False, create=False, force=False):
     except database.DatabaseError as e:
         print(e, file=sys.stderr)
         sys.exit(1)
+    if writable and db.get_version() < db.VERSION:
+        print("Upgrading database to version %d..." % db.VERSION, end=' ', file=sys.stderr)
+        try:
+            db.upgrade()
+        except database.DatabaseError as e:
+            print("failed.", file=sys.stderr)
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print("done.", file=sys.stderr)
+    return db
 
 ############################################################
 
 # readline completion class
+#
+# completes from a list of words if given, otherwise from the `name`
+# prefixed terms in the database (see Database.complete()).  matches
+# are looked up once per prefix, rather than on every call.
 class Completer:
-    def __init__(self, words):
+    LIMIT = 100
+
+    def __init__(self, words=None, db=None, name=None):
         self.words = words
+        self.db = db
+        self.name = name
+        self.prefix = None
+        self.matches = []
 
     def terms(self, prefix, index):
-        matching_words = [
-            w for w in self.words if w.startswith(prefix)
-            ]
+        if index == 0 or prefix != self.prefix:
+            self.prefix = prefix
+            if self.words is not None:
+                self.matches = [w for w in self.words if w.startswith(prefix)]
+            elif self.db:
+                self.matches = self.db.complete(self.name, prefix, self.LIMIT)
+            else:
+                self.matches = []
         try:
-            return matching_words[index]
+            return self.matches[index]
         except IndexError:
             return None
 
@@ -81,10 +119,10 @@ def prompt_for_file(infile):
 def prompt_for_source(db, sources):
     if sources:
         readline.set_startup_hook(lambda: readline.insert_text(sources[0]))
-    elif db:
-        sources = list(db.term_iter('source'))
+        completer = Completer(sources)
+    else:
+        completer = Completer(db=db, name='sid')
     readline.parse_and_bind("tab: complete")
-    completer = Completer(sources)
     readline.set_completer(completer.terms)
     readline.set_completer_delims(' ')
     source = input('source: ')
@@ -99,13 +137,9 @@ def prompt_for_tags(db, tags):
         print('initial tags: %s' % ' '.join(tags), file=sys.stderr)
     else:
         tags = []
-    if db:
-        itags = list(db.term_iter('tag'))
-    else:
-        itags = None
     readline.set_startup_hook()
     readline.parse_and_bind("tab: complete")
-    completer = Completer(itags)
+    completer = Completer(db=db, name='tag')
     readline.set_completer(completer.terms)
     readline.set_completer_delims(' ')
     while True:
@@ -139,7 +173,7 @@ def print_doc_summary(doc):
 
 ############################################################
 
-def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
+def add(db, query_string, infile=None, sid=None, tags=None, prompt=False, extra_files=[]):
 
     doc = None
     bibtex = None
@@ -148,6 +182,8 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
     doc_sid = sid
     source = None
     file_data = None
+    # local files, parsed once for scanning and indexing
+    parsed = {}
 
     if infile and infile is not True:
         infile = os.path.expanduser(infile)
@@ -156,7 +192,8 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
     # if query provided, find single doc to update
 
     if query_string:
-        if db.count(query_string) != 1:
+        # count is exact if there are less than two matches
+        if db.count(query_string, at_least=2) != 1:
             print("Search '%s' did not match a single document." % query_string, file=sys.stderr)
             print("Aborting.", file=sys.stderr)
             sys.exit(1)
@@ -177,7 +214,8 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
 
             print("Scanning document for source identifiers...", file=sys.stderr)
             try:
-                ss = sources.scan_file(infile)
+                parsed[infile] = ParsedFile(infile)
+                ss = sources.scan_file(parsed[infile])
             except ParseError as e:
                 print("\n", file=sys.stderr)
                 print("Parse error: %s" % e, file=sys.stderr)
@@ -213,7 +251,12 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
             sys.exit("String '{}' matches no known source.".format(doc_sid))
 
         # check that the source doesn't match an existing doc
-        sdoc = db.doc_for_source(source.sid)
+        try:
+            sdoc = db.doc_for_source(source.sid)
+        except database.DatabaseAmbiguityError as e:
+            print(e, file=sys.stderr)
+            print("Aborting.", file=sys.stderr)
+            sys.exit(1)
         if sdoc:
             if doc and sdoc != doc:
                 print("A different document already exists for source '%s'." % (doc_sid), file=sys.stderr)
@@ -245,10 +288,25 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
         print("Must specify source with retrieve file option.", file=sys.stderr)
         sys.exit(1)
 
+    ##################################
+    # check that the file isn't already in a different doc
+
+    # local files to add
+    paths = []
     if infile and not file_data:
-        with open(infile, 'br') as f:
-            file_data = f.read()
-        file_name = os.path.basename(infile)
+        paths.append(infile)
+    paths += [os.path.expanduser(path) for path in extra_files]
+    files = [parsed.get(path) or ParsedFile(path) for path in paths]
+
+    digests = [f.hash for f in files if os.path.isfile(f.path)]
+    if file_data:
+        digests.append(util.data_hash(file_data))
+    for digest in digests:
+        for fdoc in db.docs_for_hash(digest):
+            if not doc or fdoc.docid != doc.docid:
+                print("File already in document id:%d." % fdoc.docid, file=sys.stderr)
+                print("Aborting.", file=sys.stderr)
+                sys.exit(1)
 
     ##################################
 
@@ -277,10 +335,17 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
     if source and not doc.get_sids():
         doc.add_sid(source.sid)
 
-    if infile:
+    if file_data or paths:
         try:
             print("Adding file...", end=' ', file=sys.stderr)
-            doc.add_file_data(file_name, file_data)
+            if file_data:
+                doc.add_file_data(file_name, file_data)
+            # files not already parsed are parsed in parallel
+            with ParsePool([f for f in files if not f.parsed]) as texts:
+                for f in files:
+                    if not f.parsed:
+                        f.text = texts.get(f.path)
+                    doc.add_file(f)
             print("done.", file=sys.stderr)
         except ParseError as e:
             print("\n", file=sys.stderr)
@@ -315,52 +380,80 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
 
 ############################################
 
-def importbib(db, bibfile, tags=[], overwrite=False):
+def _read_ahead(entries, pool, size):
+    """Iterate over bib entries, reading up to `size` entries ahead.
+
+    The files of entries read ahead are added to ParsePool `pool`, so
+    that they're parsed in parallel.
+
+    """
+    ahead = collections.deque()
+    for entry in entries:
+        ahead.append(entry)
+        if entry.get_file():
+            pool.add(entry.get_file())
+        if len(ahead) > size:
+            yield ahead.popleft()
+    while ahead:
+        yield ahead.popleft()
+
+def importbib(db, bibfile, tags=[], overwrite=False, compact=False,
+              sort=True, batch_size=None):
     errors = []
 
     sources = Sources()
 
-    for entry in sorted(Bibtex(bibfile), key=lambda entry: entry.key):
-        print(entry.key, file=sys.stderr)
+    # entries are streamed from the file, unless they're sorted, and
+    # then committed in batches so memory use stays bounded
+    entries = stream_bibtex(bibfile)
+    if sort:
+        entries = sorted(entries, key=lambda entry: entry.key)
+    elif batch_size is None:
+        batch_size = 1000
 
-        try:
-            docs = []
-
-            # check for doc with this bibkey
-            bdoc = db.doc_for_bib(entry.key)
-            if bdoc:
-                docs.append(bdoc)
-
-            # check for known sids
-            for source in sources.scan_bibentry(entry):
-                sdoc = db.doc_for_source(source.sid)
-                # FIXME: why can't we match docs in list?
-                if sdoc and sdoc.docid not in [doc.docid for doc in docs]:
-                    docs.append(sdoc)
-
-            if len(docs) == 0:
-                doc = Document(db)
-            elif len(docs) > 0:
-                if len(docs) > 1:
-                    print("  Multiple distinct docs found for entry.  Using first found.", file=sys.stderr)
-                doc = docs[0]
-                print("  Updating id:%d..." % (doc.docid), file=sys.stderr)
-
-            doc.add_bibentry(entry)
-
-            filepath = entry.get_file()
-            if filepath:
-                print("  Adding file: %s" % filepath, file=sys.stderr)
-                doc.add_file(filepath)
+    with db.batch(size=batch_size), ParsePool(()) as texts:
+        for entry in _read_ahead(entries, texts, 2 * texts.workers):
+            print(entry.key, file=sys.stderr)
 
-            doc.add_tags(tags)
+            try:
+                docs = []
 
-            doc.sync()
+                # check for docs with this bibkey or any known sids
+                found = db.docs_for_bibs([entry.key])[entry.key]
+                sids = [source.sid for source in sources.scan_bibentry(entry)]
+                for sdocs in db.docs_for_sources(sids).values():
+                    found += sdocs
+                for fdoc in found:
+                    # FIXME: why can't we match docs in list?
+                    if fdoc.docid not in [doc.docid for doc in docs]:
+                        docs.append(fdoc)
 
-        except BibtexError as e:
-            print("  Error processing entry %s: %s" % (entry.key, e), file=sys.stderr)
-            print(file=sys.stderr)
-            errors.append(entry.key)
+                if len(docs) == 0:
+                    doc = Document(db)
+                elif len(docs) > 0:
+                    if len(docs) > 1:
+                        print("  Multiple distinct docs found for entry.  Using first found.", file=sys.stderr)
+                    doc = docs[0]
+                    print("  Updating id:%d..." % (doc.docid), file=sys.stderr)
+
+                doc.add_bibentry(entry)
+
+                filepath = entry.get_file()
+                if filepath:
+                    print("  Adding file: %s" % filepath, file=sys.stderr)
+                    doc.add_file(filepath, text=texts.get(filepath))
+
+                doc.add_tags(tags)
+
+                doc.sync()
+
+            except BibtexError as e:
+                print("  Error processing entry %s: %s" % (entry.key, e), file=sys.stderr)
+                print(file=sys.stderr)
+                errors.append(entry.key)
+
+    if compact:
+        compactdb(db)
 
     if errors:
         print(file=sys.stderr)
@@ -378,7 +471,67 @@ def importbib(db, bibfile, tags=[], overwrite=False):
 
 ############################################
 
-def search(db, query_string, oformat='summary', sort='relevance', limit=None):
+def compactdb(db):
+    print("Compacting database...", end=' ', file=sys.stderr)
+    start = time.time()
+    try:
+        before, after = db.compact()
+    except database.DatabaseError as e:
+        print("failed.", file=sys.stderr)
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print("done.", file=sys.stderr)
+    print("%.1f MB -> %.1f MB (%.0f%%) in %.1f s" % (
+        before / 1e6, after / 1e6,
+        100.0 * after / before if before else 100,
+        time.time() - start),
+        file=sys.stderr)
+
+############################################
+
+def dedup(db):
+    print("Deduplicating document files...", file=sys.stderr)
+    linked, saved, removed = db.dedup(log=True)
+    print("%d files in blob store, %.1f MB saved, %d unused blobs removed." % (
+        linked, saved / 1e6, removed), file=sys.stderr)
+
+############################################
+
+def tag(query_string, add_tags=[], remove_tags=[]):
+    try:
+        with initdb(writable=True, lock_error=True) as db, db.batch():
+            for doc in db.search(query_string):
+                doc.add_tags(add_tags)
+                doc.remove_tags(remove_tags)
+                doc.sync()
+        return
+    except database.DatabaseLockError as e:
+        print(e, end=' ', file=sys.stderr)
+
+    # queue the changes for the writer holding the lock to apply
+    with initdb() as db:
+        docids = [doc.docid for doc in db.search(query_string)]
+        db.queue.put(docids, add_tags, remove_tags)
+        root = db.root
+    print("Queued tag changes for %d documents." % len(docids), file=sys.stderr)
+    apply_queue(root)
+
+def apply_queue(root):
+    """Apply queued changes if the database is not locked.
+
+    The lock may have been released before changes were queued, in
+    which case no writer would apply them.
+
+    """
+    try:
+        with database.Database(root, writable=True):
+            pass
+    except database.DatabaseLockError:
+        pass
+
+############################################
+
+def search(db, query_string, oformat='summary', sort='relevance', limit=None, offset=0):
     if query_string == '*' and oformat in ['tags','sources','keys']:
         if oformat == 'tags':
             for tag in db.tag_iter():
@@ -391,10 +544,21 @@ def search(db, query_string, oformat='summary', sort='relevance', limit=None):
                 print(key)
         return
 
+    # tags and sources of all matching documents are counted as
+    # facets, without retrieving the documents
+    if oformat in ['tags','sources'] and not limit and not offset:
+        if oformat == 'tags':
+            name = 'tag'
+        else:
+            name = 'sid'
+        for value in sorted(db.facets(query_string, [name])[name]):
+            print(value)
+        return
+
     otags = set([])
     osources = set([])
 
-    for doc in db.search(query_string, sort=sort, limit=limit):
+    for doc in db.search(query_string, sort=sort, limit=limit, offset=offset):
         if oformat in ['summary']:
             print_doc_summary(doc)
             continue
@@ -431,6 +595,19 @@ def search(db, query_string, oformat='summary', sort='relevance', limit=None):
 
 ############################################
 
+def facets(db, query_string, names=None, prefix=True):
+    counts = db.facets(query_string, names)
+    for name in names or db.FACETS:
+        # order by count, then by value
+        values = sorted(counts[name].items(), key=lambda item: (-item[1], item[0]))
+        for value, count in values:
+            if prefix:
+                print("%d\t%s:%s" % (count, name, value))
+            else:
+                print("%d\t%s" % (count, value))
+
+############################################
+
 def export(db, outdir, query_string):
     try:
         os.makedirs(outdir)
@@ -20,10 +20,23 @@ Jameson Rollins <jrollins@finestructure.net>
 
 import os
 import sys
+import time
+import shutil
 import xapian
+import datetime
+import tempfile
+import itertools
+import json
+import collections
+import multiprocessing
+import concurrent.futures
 
 from . import util
+from .cache import SearchCache, TextCache
+from .writequeue import WriteQueue, retry
 from .source import Sources
+from . import parser
+from .parser import ParsePool
 from .documents import Documents, Document
 
 # FIXME: add db schema documentation
@@ -46,10 +59,294 @@ class DatabaseInitializationError(DatabaseError):
 class DatabaseLockError(DatabaseError):
     pass
 
+class DatabaseAmbiguityError(DatabaseError):
+    pass
+
 DatabaseModifiedError = xapian.DatabaseModifiedError
 
 ##################################################
 
+class Batch():
+    """Represents a batch of document writes to a Xapers database.
+
+    Created with Database.batch().  Documents synced while the batch
+    is open are indexed inside a Xapian transaction, and their docdir
+    writes are held until the transaction is committed.  If `size` is
+    specified, the transaction is committed every `size` documents,
+    otherwise everything is committed when the batch is closed.  If an
+    exception is raised, all uncommitted documents are rolled back,
+    both in the index and in the docdirs.
+
+    """
+    def __init__(self, db, size=None):
+        self.db = db
+        self.size = size
+        # pending documents by docid
+        self.docs = collections.OrderedDict()
+        self._nested = False
+        self._active = False
+
+    def __enter__(self):
+        # batches don't nest; inner batches are merged into the outer
+        if self.db._batch:
+            self._nested = True
+            return self.db._batch
+        self.db._batch = self
+        self._begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._nested:
+            return
+        self.db._batch = None
+        if exc_type:
+            self._cancel()
+        else:
+            self._commit()
+
+    def _begin(self):
+        self.db._writer.begin_transaction()
+        self._active = True
+
+    def _cancel(self):
+        if self._active:
+            self._active = False
+            self.db._writer.cancel_transaction()
+        self.docs.clear()
+
+    def _commit(self):
+        if not self._active:
+            return
+        backup = tempfile.mkdtemp(prefix='batch.', dir=os.path.join(self.db.root, '.xapers'))
+        undo = []
+        try:
+            for doc in self.docs.values():
+                self._stage_docdir(doc, backup, undo)
+                doc._write_docdir()
+            self._active = False
+            self.db._writer.commit_transaction()
+        except:
+            try:
+                self._rollback_docdirs(undo)
+            except Exception as e:
+                # keep the moved aside files that weren't restored
+                self._cancel()
+                raise DatabaseError(
+                    "Failed to roll back docdir writes (%s); original files are in %s."
+                    % (e, backup)) from e
+            self._cancel()
+            shutil.rmtree(backup)
+            raise
+        shutil.rmtree(backup)
+        self.docs.clear()
+
+    # record how to undo the docdir writes for a document, moving
+    # aside any files that will be overwritten
+    def _stage_docdir(self, doc, backup, undo):
+        if not os.path.isdir(doc.docdir):
+            undo.append(('rmdir', doc.docdir, None))
+            return
+        for name in doc._docdir_names():
+            path = os.path.join(doc.docdir, name)
+            if os.path.exists(path):
+                bpath = os.path.join(backup, '%d.%d' % (doc.docid, len(undo)))
+                if name in ['bibtex', 'tags']:
+                    shutil.copy2(path, bpath)
+                else:
+                    os.rename(path, bpath)
+                undo.append(('restore', path, bpath))
+            else:
+                undo.append(('remove', path, None))
+
+    def _rollback_docdirs(self, undo):
+        for action, path, bpath in reversed(undo):
+            if action == 'rmdir':
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+            elif action == 'remove':
+                if os.path.exists(path):
+                    os.remove(path)
+            elif action == 'restore':
+                os.replace(bpath, path)
+
+    def add(self, doc):
+        """Add synced document to batch."""
+        if not self._active:
+            raise DatabaseError("Batch is not open.")
+        old = self.docs.pop(doc.docid, None)
+        if old:
+            # keep files and bibtex from the earlier pending sync
+            for name, data in list(doc._infiles.items()):
+                old._inpaths.pop(name, None)
+                old._infiles[name] = data
+            for name, path in list(doc._inpaths.items()):
+                old._infiles.pop(name, None)
+                old._inpaths[name] = path
+            doc._infiles = old._infiles
+            doc._inpaths = old._inpaths
+            if not doc.bibentry:
+                doc.bibentry = old.bibentry
+        self.docs[doc.docid] = doc
+        if self.size and len(self.docs) >= self.size:
+            self._commit()
+            self._begin()
+
+    def get_bibentry(self, docid):
+        """Return pending bibentry for docid, or None."""
+        if docid in self.docs:
+            return self.docs[docid].bibentry
+
+##################################################
+
+# restore worker processes each open the database read-only, and
+# build complete documents from docdirs for the writer to insert
+_restore_db = None
+
+def _restore_init(root):
+    global _restore_db
+    _restore_db = Database(root)
+
+# build the document for a docdir, returning the docid and the
+# serialised Xapian document
+def _restore_docdir(docid, docdir, docfiles):
+    db = _restore_db
+    # pick up documents committed since the last docdir
+    db.reopen()
+    try:
+        doc = db[docid]
+    except xapian.DocNotFoundError:
+        doc = Document(db, docid=docid)
+        doc._set_date('added', os.stat(docdir).st_mtime)
+    db._index_docdir(doc, docfiles)
+    # documents rebuilt from scratch were last modified when their
+    # docdir last changed
+    if doc.get_modified() is None:
+        paths = [os.path.join(docdir, f) for f in docfiles] + [docdir]
+        doc._set_date('modified', max(os.stat(p).st_mtime for p in paths))
+    doc._set_dates(touch=False)
+    doc._set_record()
+    return docid, doc.xapian_doc.serialise()
+
+##################################################
+
+# parse a date range string into seconds since the epoch, for the
+# start of the period, or the end if `end` is True.  Dates can be
+# YYYY, YYYY-MM, YYYY-MM-DD, or <N>d or <N>w for N days or weeks
+# before today.
+def parse_date(string, end=False):
+    today = datetime.date.today()
+    if string[-1:] in ['d', 'w'] and string[:-1].isdigit():
+        days = int(string[:-1])
+        if string[-1] == 'w':
+            days *= 7
+        start = today - datetime.timedelta(days=days)
+        period = datetime.timedelta(days=1)
+    else:
+        parts = [int(p) for p in string.split('-')]
+        if len(parts) == 1:
+            start = datetime.date(parts[0], 1, 1)
+            period = datetime.date(parts[0] + 1, 1, 1) - start
+        elif len(parts) == 2:
+            start = datetime.date(parts[0], parts[1], 1)
+            period = datetime.date(parts[0] + parts[1] // 12, parts[1] % 12 + 1, 1) - start
+        elif len(parts) == 3:
+            start = datetime.date(*parts)
+            period = datetime.timedelta(days=1)
+        else:
+            raise ValueError("invalid date: %s" % string)
+    timestamp = time.mktime(start.timetuple())
+    if end:
+        timestamp = time.mktime((start + period).timetuple()) - 1
+    return timestamp
+
+
+class DateRangeProcessor(xapian.RangeProcessor):
+    """Xapian range processor for date value facets.
+
+    Dates are parsed with parse_date(), and ranges are inclusive of
+    the full start and end periods.
+
+    """
+    def __init__(self, slot, prefix):
+        xapian.RangeProcessor.__init__(self, slot, prefix)
+        self.slot = slot
+
+    def __call__(self, begin, end):
+        try:
+            if begin:
+                begin = xapian.sortable_serialise(parse_date(begin))
+            if end:
+                end = xapian.sortable_serialise(parse_date(end, end=True))
+        except ValueError:
+            # not a date range we understand
+            return xapian.Query(xapian.Query.OP_INVALID)
+        if begin and end:
+            return xapian.Query(xapian.Query.OP_VALUE_RANGE, self.slot, begin, end)
+        elif begin:
+            return xapian.Query(xapian.Query.OP_VALUE_GE, self.slot, begin)
+        else:
+            return xapian.Query(xapian.Query.OP_VALUE_LE, self.slot, end)
+
+##################################################
+
+class ShardWriter():
+    """Writable shard of a sharded Xapers database.
+
+    Documents are spread over the `count` shards by docid, such that
+    shard `index` holds the documents with (docid - 1) % count ==
+    index, as in Xapian's combined databases.  Documents are addressed
+    by their combined docid, and writes of documents belonging to
+    other shards raise a DatabaseError.  Everything else is passed
+    through to the shard's WritableDatabase.
+
+    """
+    def __init__(self, xapian_db, index, count):
+        self.xapian = xapian_db
+        self.index = index
+        self.count = count
+
+    def _shard_docid(self, docid):
+        if (docid - 1) % self.count != self.index:
+            raise DatabaseError("Document %d is not in shard %d." % (docid, self.index))
+        return (docid - 1) // self.count + 1
+
+    def replace_document(self, docid, doc):
+        self.xapian.replace_document(self._shard_docid(docid), doc)
+
+    def delete_document(self, docid):
+        self.xapian.delete_document(self._shard_docid(docid))
+
+    def __getattr__(self, name):
+        return getattr(self.xapian, name)
+
+##################################################
+
+class FacetSpy(xapian.MatchSpy):
+    """Xapian match spy counting facets of matching Xapers documents.
+
+    Values are read from the document records (see Document.sync()),
+    so no bibtex is parsed.
+
+    """
+    def __init__(self, db, names):
+        xapian.MatchSpy.__init__(self)
+        self.db = db
+        self.counts = dict((name, collections.Counter()) for name in names)
+
+    def __call__(self, xapian_doc, wt):
+        doc = Document(self.db, xapian_doc)
+        for name, counter in self.counts.items():
+            if name == 'tag':
+                counter.update(doc.get_tags())
+            elif name == 'sid':
+                counter.update(doc.get_sids())
+            elif name == 'source':
+                counter.update(set(sid.split(':', 1)[0] for sid in doc.get_sids()))
+            elif name == 'author':
+                counter.update(set(doc.get_authors() or []))
+
+##################################################
+
 class Database():
     """Represents a Xapers database"""
 
@@ -70,6 +367,8 @@ class Database():
         # FIXME: use this for doi?
         #'url': 'U',
         'file': 'P',
+        # SHA-256 of file contents
+        'hash': 'XHASH|',
 
         # FIXME: use this for doc mime type
         'type': 'T',
@@ -88,12 +387,36 @@ class Database():
         'y': 0,
         }
 
+    # date values, stored as serialised seconds since the epoch
+    DATE_VALUE_FACET = {
+        'added': 2,
+        'modified': 3,
+        }
+
+    # text fields, and those indexed with positional information by
+    # default.  positions are only needed for phrase searches, and
+    # make up most of the index for file text.
+    INDEX_FIELDS = ['title', 'author', 'file']
+    POSITIONS = ['title', 'author']
+
+    # values holding internal document data
+    VALUE_INTERNAL = {
+        # serialised record of document display metadata
+        'record': 1,
+        }
+
     # FIXME: need to set the following value fields:
     # publication date
-    # added date
-    # modified date
 
-    # FIXME: need database version
+    # facets that can be counted for searches, see facets()
+    FACETS = ['tag', 'source', 'sid', 'year', 'author']
+
+    # database schema version, stored in the 'version' metadata key
+    # 0: original schema
+    # 1: document display records stored in 'record' value
+    # 2: document added and modified date values
+    # 3: file content hash terms
+    VERSION = 3
 
     def _find_prefix(self, name):
         # FIXME: make this a dictionary union
@@ -109,15 +432,26 @@ class Database():
     def _find_facet(self, name):
         if name in self.NUMBER_VALUE_FACET:
             return self.NUMBER_VALUE_FACET[name]
+        if name in self.DATE_VALUE_FACET:
+            return self.DATE_VALUE_FACET[name]
+
+    def _find_value(self, name):
+        if name in self.VALUE_INTERNAL:
+            return self.VALUE_INTERNAL[name]
 
     def _make_source_prefix(self, source):
         return 'X%s|' % (source.upper())
 
     ########################################
 
-    def __init__(self, root, writable=False, create=False, force=False):
+    def __init__(self, root, writable=False, create=False, force=False, lock_timeout=0,
+                 shards=None, shard=None):
         # xapers root
         self.root = os.path.abspath(os.path.expanduser(root))
+        self.writable = writable
+
+        # open write batch
+        self._batch = None
 
         # xapers db directory
         xapers_path = os.path.join(self.root, '.xapers')
@@ -135,15 +469,68 @@ class Database():
                 else:
                     raise DatabaseUninitializedError("Xapers directory '%s' not found." % (self.root))
 
-        # the Xapian db
-        xapian_path = os.path.join(xapers_path, 'xapian')
+        # queue of mutations waiting for the write lock
+        self.queue = WriteQueue(os.path.join(xapers_path, 'queue'))
+
+        # the Xapian db, either a single database in .xapers/xapian,
+        # or a set of shards in .xapers/shards that are searched as
+        # one.  new databases are sharded if `shards` > 1.
+        self._xapian_path = os.path.join(xapers_path, 'xapian')
+        self._shards_path = os.path.join(xapers_path, 'shards')
+        if create and shards and shards > 1 \
+           and not os.path.exists(self._xapian_path) \
+           and not os.path.exists(self._shards_path):
+            self._create_shards(shards)
+        paths = self._shard_paths()
+
+        # if `shard` is specified only that shard is opened writable,
+        # so that writers on different shards can work in parallel
+        self.lock_timeout = lock_timeout
+        if shard is not None and not 0 <= shard < len(paths):
+            raise DatabaseError("Shard %d does not exist." % shard)
+        if len(paths) == 1:
+            shard = None
+        self.shard = shard
+
+        # self._shards holds the per-shard databases, self.xapian the
+        # combined database used for all reads, and self._writer the
+        # database (or shard) that writes go to
+        self._shards = []
+        try:
+            for i, path in enumerate(paths):
+                if writable and shard in [None, i]:
+                    self._shards.append(self._open_writable(path, lock_timeout))
+                else:
+                    self._shards.append(xapian.Database(path))
+        except:
+            for db in self._shards:
+                db.close()
+            raise
+        if len(self._shards) == 1:
+            self.xapian = self._shards[0]
+        else:
+            if writable and shard is None:
+                self.xapian = xapian.WritableDatabase()
+            else:
+                self.xapian = xapian.Database()
+            for db in self._shards:
+                self.xapian.add_database(db)
+        if shard is None:
+            self._writer = self.xapian
+        else:
+            self._writer = ShardWriter(self._shards[shard], shard, len(self._shards))
+
         if writable:
-            try:
-                self.xapian = xapian.WritableDatabase(xapian_path, xapian.DB_CREATE_OR_OPEN)
-            except xapian.DatabaseLockError:
-                raise DatabaseLockError("Xapers database locked.")
+            # new databases are created with the current schema
+            if self.xapian.get_doccount() == 0 and not self.xapian.get_metadata('version'):
+                self._writer.set_metadata('version', str(self.VERSION))
+
+        # per-field positional indexing policy
+        positions = self.xapian.get_metadata('positions')
+        if positions:
+            self.positions = json.loads(positions)
         else:
-            self.xapian = xapian.Database(xapian_path)
+            self.positions = list(self.POSITIONS)
 
         stemmer = xapian.Stem("english")
 
@@ -177,24 +564,144 @@ class Database():
             self.query_parser.add_valuerangeprocessor(
                 xapian.NumberValueRangeProcessor(facet, name+':')
                 )
-
-        # register known source prefixes
-        # FIXME: can we do this by just finding all XSOURCE terms in
-        #        db?  Would elliminate dependence on source modules at
-        #        search time.
-        for source in Sources():
-            name = source.name
+        # keep references to the range processors, since the query
+        # parser does not
+        self._range_processors = []
+        for name, facet in self.DATE_VALUE_FACET.items():
+            rp = DateRangeProcessor(facet, name+':')
+            self.query_parser.add_rangeprocessor(rp)
+            self._range_processors.append(rp)
+
+        # register source prefixes, for all sources in the db and all
+        # available source modules.  source modules are not loaded.
+        names = set(self.term_iter('source'))
+        names.update(source.name for source in Sources())
+        for name in names:
             self.query_parser.add_boolean_prefix(name, self._make_source_prefix(name))
 
+        # place document files by hard link, rather than copying
+        self.hardlink_files = bool(os.getenv('XAPERS_HARDLINK_FILES'))
+
+        # optional content-addressed store of document files, that
+        # docdir files are hard links to.  used if it exists, or
+        # XAPERS_BLOB_STORE is set.
+        self.blob_path = os.path.join(xapers_path, 'blobs')
+        self.use_blobs = bool(os.getenv('XAPERS_BLOB_STORE')) or os.path.isdir(self.blob_path)
+
+        # optional search result cache, for read-only databases
+        # (uncommitted changes in writable databases are visible to
+        # searches but don't change the revision)
+        self._cache = None
+        size = os.getenv('XAPERS_SEARCH_CACHE')
+        if size and int(size) > 0 and not writable:
+            self._cache = SearchCache(os.path.join(xapers_path, 'cache'), int(size))
+
+        # cache of text extracted from document files, so that files
+        # are only parsed once.  size in MiB, or 0 to disable.
+        size = int(os.getenv('XAPERS_TEXT_CACHE', 512))
+        if size > 0:
+            parser.set_text_cache(TextCache(os.path.join(xapers_path, 'text'), size << 20))
+        else:
+            parser.set_text_cache(None)
+
+        if writable and shard is None:
+            self.apply_queue()
+
+    # wait up to lock_timeout seconds for the write lock
+    def _open_writable(self, path, lock_timeout):
+        try:
+            return retry(
+                lambda: xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN),
+                xapian.DatabaseLockError, lock_timeout)
+        except xapian.DatabaseLockError:
+            raise DatabaseLockError("Xapers database locked.")
+
+    def _shard_paths(self):
+        if os.path.isdir(self._shards_path):
+            return [os.path.join(self._shards_path, name)
+                    for name in sorted(os.listdir(self._shards_path))]
+        return [self._xapian_path]
+
+    # create the shard databases in a temporary directory and rename
+    # it into place, so that concurrent creators agree on one set
+    def _create_shards(self, count):
+        tmp = tempfile.mkdtemp(prefix='shards.', dir=os.path.dirname(self._shards_path))
+        try:
+            for i in range(count):
+                db = xapian.WritableDatabase(os.path.join(tmp, '%02d' % i), xapian.DB_CREATE)
+                db.set_metadata('version', str(self.VERSION))
+                db.close()
+            os.rename(tmp, self._shards_path)
+        except OSError:
+            if not os.path.isdir(self._shards_path):
+                raise
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        # apply anything queued while we held the lock.  exiting
+        # (e.g. at the end of an import) counts as completion.
+        if self.writable and self.shard is None \
+           and (exc_type is None or issubclass(exc_type, SystemExit)):
+            self.apply_queue()
         self.xapian.close()
 
     def reopen(self):
         self.xapian.reopen()
 
+    # revision of the database, as a string of shard revisions
+    def _revision(self):
+        return ','.join(str(db.get_revision()) for db in self._shards)
+
+    def _cache_get(self, key):
+        if self._cache:
+            return self._cache.get(key, self._revision())
+
+    def _cache_set(self, key, value):
+        if self._cache:
+            self._cache.set(key, self._revision(), value)
+
+    def batch(self, size=None):
+        """Return a context manager for a batch of document writes.
+
+        Index and docdir changes of documents synced inside the batch
+        are committed together, every `size` documents if specified,
+        otherwise when the batch is closed.  Uncommitted changes are
+        rolled back if an exception is raised.  Database must be
+        writable.
+
+        """
+        return Batch(self, size=size)
+
+    def apply_queue(self):
+        """Apply mutations queued while the database was locked.
+
+        Queued entries are applied in order in a single batch, and
+        removed from the queue once committed.  Returns the number of
+        entries applied.  Database must be writable (all shards).
+
+        """
+        entries = list(self.queue)
+        if not entries:
+            return 0
+        with self.batch():
+            for path, entry in entries:
+                for docid in entry['docids']:
+                    try:
+                        doc = self[docid]
+                    except xapian.DocNotFoundError:
+                        continue
+                    doc.add_tags(entry['add'])
+                    doc.remove_tags(entry['remove'])
+                    doc.sync()
+        for path, entry in entries:
+            self.queue.remove(path)
+        return len(entries)
+
     def __contains__(self, docid):
         try:
             self.xapian.get_document(docid)
@@ -210,8 +717,221 @@ class Database():
 
     ########################################
 
-    # generate a new doc id, based on the last availabe doc id
+    def set_positions(self, fields):
+        """Set fields to be indexed with positional information.
+
+        Positions are needed for phrase searches of a field.  The
+        policy is stored in the database (and committed with the next
+        commit), but only applies to documents indexed after it is
+        set; use reindex() to apply it to existing documents.
+
+        """
+        for field in fields:
+            if field not in self.INDEX_FIELDS:
+                raise ValueError("unknown index field '%s'" % field)
+        self.positions = list(fields)
+        self._writer.set_metadata('positions', json.dumps(self.positions))
+
+    def get_version(self):
+        """Return the database schema version."""
+        version = self.xapian.get_metadata('version')
+        if not version:
+            return 0
+        return int(version)
+
+    def upgrade(self, log=False):
+        """Upgrade database to the current schema version.
+
+        Documents are updated in place from the data in the Xapers
+        root.  Database must be writable.
+
+        """
+        version = self.get_version()
+        if version >= self.VERSION:
+            return
+        if self.shard is not None:
+            raise DatabaseError("Upgrade requires all shards to be writable.")
+        for docid in list(self._docid_iter('')):
+            doc = self[docid]
+            if log:
+                print('  id:%d' % doc.docid, file=sys.stderr)
+            if version < 1:
+                # store display record
+                doc._set_record()
+            if version < 3:
+                # hash existing files
+                for path in doc.get_fullpaths():
+                    if os.path.exists(path):
+                        doc._add_file_hash(util.file_hash(path))
+            if version < 2 and doc.get_added() is None:
+                # docdir modification time is the best guess for the
+                # added date
+                try:
+                    mtime = os.stat(doc.docdir).st_mtime
+                except OSError:
+                    mtime = time.time()
+                doc._set_date('added', mtime)
+                doc._set_date('modified', mtime)
+            self.replace_document(doc.docid, doc.xapian_doc)
+        self._writer.set_metadata('version', str(self.VERSION))
+        self._writer.commit()
+
+    ########################################
+
+    def compact(self):
+        """Compact the Xapian index.
+
+        A compacted copy of the index (of each shard) is written next
+        to the current one, and the two are swapped while holding the
+        write lock.  Docids are not renumbered.  Returns the index size
+        in bytes before and after compaction.  Database must be
+        writable (all shards), with no open batch.
+
+        Queued changes are applied first.  The compacted databases are
+        then reopened at their real paths.  If another writer takes
+        the lock in between, the database is reopened read-only.
+
+        """
+        if self.shard is not None:
+            raise DatabaseError("Compaction requires all shards to be writable.")
+        self.apply_queue()
+        self.xapian.commit()
+        before = after = 0
+        shards = []
+        for path, db in zip(self._shard_paths(), self._shards):
+            compact_path = path + '.compact'
+            if os.path.exists(compact_path):
+                shutil.rmtree(compact_path)
+            before += util.dir_size(path)
+            db.compact(compact_path, xapian.DBCOMPACT_NO_RENUMBER)
+            # take the lock on the compacted copy before swapping it
+            # in, so no other writer can get in between
+            shards.append(xapian.WritableDatabase(compact_path, xapian.DB_OPEN))
+            util.exchange_paths(path, compact_path)
+            db.close()
+            after += util.dir_size(path)
+        self.xapian.close()
+
+        # the compacted databases were opened at the paths that now
+        # hold the old ones, so reopen them where they are now
+        for db in shards:
+            db.close()
+        for path in self._shard_paths():
+            shutil.rmtree(path + '.compact')
+        self._shards = []
+        try:
+            for path in self._shard_paths():
+                self._shards.append(self._open_writable(path, self.lock_timeout))
+        except DatabaseLockError:
+            for db in self._shards:
+                db.close()
+            self.writable = False
+            self._shards = [xapian.Database(path) for path in self._shard_paths()]
+        if len(self._shards) == 1:
+            self.xapian = self._shards[0]
+        else:
+            if self.writable:
+                self.xapian = xapian.WritableDatabase()
+            else:
+                self.xapian = xapian.Database()
+            for db in self._shards:
+                self.xapian.add_database(db)
+        self._writer = self.xapian
+        self.query_parser.set_database(self.xapian)
+        return before, after
+
+    # path of blob in the blob store
+    def _blob(self, digest):
+        return os.path.join(self.blob_path, digest[:2], digest[2:])
+
+    # store file src (or data) in the blob store, if not already
+    # there, returning the blob path.  blobs are read-only, since they
+    # are shared between docdirs.
+    def _store_blob(self, digest, src=None, data=None):
+        blob = self._blob(digest)
+        if os.path.exists(blob):
+            return blob
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(blob))
+        os.close(fd)
+        try:
+            if data is not None:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+            else:
+                os.remove(tmp)
+                util.place_file(src, tmp)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, blob)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return blob
+
+    def dedup(self, log=False):
+        """Move document files into the content-addressed blob store.
+
+        Every docdir file (other than bibtex and tags) is replaced
+        with a hard link to the blob with its content, so identical
+        files are stored once.  Blobs no longer referenced by any
+        docdir are removed.  Once the blob store exists, new files
+        are placed in it as well.  Returns a tuple of the number of
+        files linked, the bytes saved, and the number of blobs
+        removed.
+
+        """
+        self.use_blobs = True
+        linked = saved = removed = 0
+        for ddir in sorted(os.listdir(self.root)):
+            docdir = os.path.join(self.root, ddir)
+            if not ddir.isdigit() or not os.path.isdir(docdir):
+                continue
+            for name in sorted(os.listdir(docdir)):
+                path = os.path.join(docdir, name)
+                if name in ['bibtex', 'tags'] or not os.path.isfile(path):
+                    continue
+                digest = util.file_hash(path)
+                blob = self._blob(digest)
+                if not os.path.exists(blob):
+                    if os.stat(path).st_nlink > 1:
+                        # the file is shared (e.g. hard linked from
+                        # the user's original, see XAPERS_HARDLINK_FILES),
+                        # so copy it rather than making it read-only
+                        self._store_blob(digest, src=path)
+                    else:
+                        # first copy of this content becomes the blob
+                        os.makedirs(os.path.dirname(blob), exist_ok=True)
+                        os.link(path, blob)
+                        os.chmod(blob, 0o444)
+                if not os.path.samefile(path, blob):
+                    st = os.stat(path)
+                    tmp = os.path.join(docdir, '.%s.blob' % name)
+                    os.link(blob, tmp)
+                    os.replace(tmp, path)
+                    # shared files aren't freed by unlinking them
+                    if st.st_nlink == 1:
+                        saved += st.st_size
+                    if log:
+                        print('  %s: linked to existing blob' % path, file=sys.stderr)
+                linked += 1
+        for bdir, dirs, files in os.walk(self.blob_path):
+            for name in files:
+                blob = os.path.join(bdir, name)
+                if os.stat(blob).st_nlink == 1:
+                    os.remove(blob)
+                    removed += 1
+        return linked, saved, removed
+
+    # whether docid can be written to
+    def _in_shard(self, docid):
+        return self.shard is None or (docid - 1) % len(self._shards) == self.shard
+
+    # generate a new doc id, based on the last availabe doc id.  for
+    # a single writable shard, this is the next docid in that shard.
     def _generate_docid(self):
+        if self.shard is not None:
+            return self._writer.get_lastdocid() * len(self._shards) + self.shard + 1
         return self.xapian.get_lastdocid() + 1
 
     ########################################
@@ -245,6 +965,36 @@ class Database():
         """Get all source ids in database as a list"""
         return [sid for sid in self.sid_iter()]
 
+    def _complete(self, prefix, partial, limit):
+        start = None
+        if partial:
+            start = util.get_full_term(prefix, partial)[len(prefix):]
+        values = util.xapian_term_iter(self.xapian, prefix, start=start)
+        values = itertools.takewhile(lambda v: v.startswith(partial), values)
+        return sorted(itertools.islice(values, limit))
+
+    def complete(self, name, partial, limit=None):
+        """Complete a partial term value.
+
+        Returns a sorted list of up to `limit` values of the `name`
+        prefixed terms (e.g. 'tag', 'key' or 'source') that start with
+        `partial`.  The values are found by seeking directly to the
+        partial value in the sorted term list.  For 'sid', partial
+        source names are completed to '<source>:', and partial ids
+        to full source ids.
+
+        """
+        if name == 'sid':
+            if ':' not in partial:
+                return [source + ':' for source in self.complete('source', partial, limit)]
+            source, oid = partial.split(':', 1)
+            prefix = self._make_source_prefix(source)
+            return ['%s:%s' % (source, value) for value in self._complete(prefix, oid, limit)]
+        prefix = self._find_prefix(name)
+        if not prefix:
+            raise ValueError("unknown term name '%s'" % name)
+        return self._complete(prefix, partial, limit)
+
     def tag_iter(self):
         """Generator of all tags in database"""
         for tag in self.term_iter('tag'):
@@ -256,17 +1006,17 @@ class Database():
 
     ########################################
 
-    # search for documents based on query string and return mset
-    def _search(self, query_string, sort='relevance', limit=None):
+    # return enquire for documents matching query string
+    def _enquire(self, query_string, sort='relevance'):
         enquire = xapian.Enquire(self.xapian)
 
         # FIXME: add option for ascending/descending
         if sort == 'relevance':
             enquire.set_sort_by_relevance_then_value(self.NUMBER_VALUE_FACET['year'], True)
-        elif sort == 'year':
-            enquire.set_sort_by_value_then_relevance(self.NUMBER_VALUE_FACET['year'], True)
+        elif sort in ['year', 'added', 'modified']:
+            enquire.set_sort_by_value_then_relevance(self._find_facet(sort), True)
         else:
-            raise ValueError("sort parameter accepts only 'relevance' or 'year'")
+            raise ValueError("sort parameter accepts only 'relevance', 'year', 'added' or 'modified'")
 
         if query_string == "*":
             query = xapian.Query.MatchAll
@@ -285,115 +1035,451 @@ class Database():
         # FIXME: make this user specifiable
         enquire.set_docid_order(xapian.Enquire.DESCENDING)
 
-        if limit:
-            mset = enquire.get_mset(0, limit)
-        else:
-            mset = enquire.get_mset(0, self.xapian.get_doccount())
-
-        return mset
+        return enquire
 
-    def search(self, query_string, sort='relevance', limit=None):
+    def search(self, query_string, sort='relevance', limit=None, offset=0, page_size=None):
         """Search for documents in the database.
 
-        The `sort` keyword argument can be 'relevance' (default) or
-        'year'.  `limit` can be used to limit the number of returned
-        documents (default is None).
+        The `sort` keyword argument can be 'relevance' (default),
+        'year', 'added' or 'modified'.  `limit` can be used to limit
+        the number of returned documents (default is None), and
+        `offset` to skip the first matching documents.  Documents are
+        retrieved from the index in pages of `page_size` documents as
+        they are needed (default is Documents.PAGE_SIZE).
+
+        If the XAPERS_SEARCH_CACHE environment variable is set to a
+        number of entries, matches and counts are cached on disk for
+        read-only databases, until the database is modified.
 
         """
-        mset = self._search(query_string, sort=sort, limit=limit)
-        return Documents(self, mset)
+        # check the sort parameter now rather than on first access
+        if sort not in ['relevance', 'year', 'added', 'modified']:
+            raise ValueError("sort parameter accepts only 'relevance', 'year', 'added' or 'modified'")
+        return Documents(self, query_string, sort=sort,
+                         offset=offset, limit=limit, page_size=page_size)
 
-    def count(self, query_string):
-        """Count documents matching search terms."""
-        return self._search(query_string).get_matches_estimated()
+    def count_bounds(self, query_string, exact=False, at_least=0):
+        """Bounds on the number of documents matching search terms.
 
-    def _doc_for_term(self, term):
-        enquire = xapian.Enquire(self.xapian)
-        query = xapian.Query(term)
-        enquire.set_query(query)
-        mset = enquire.get_mset(0, 2)
-        # FIXME: need to throw an exception if more than one match found
-        if mset:
-            return Document(self, mset[0].document)
+        Returns a (lower, estimated, upper) tuple.  The bounds are
+        exact if there are no more than `at_least` matches, or if
+        `exact` is True (in which case all matches are checked).  No
+        documents are retrieved.
+
+        """
+        if exact:
+            at_least = self.xapian.get_doccount()
+        key = ['count', query_string, at_least]
+        bounds = self._cache_get(key)
+        if bounds is None:
+            enquire = self._enquire(query_string)
+            mset = enquire.get_mset(0, 0, at_least)
+            bounds = [mset.get_matches_lower_bound(),
+                      mset.get_matches_estimated(),
+                      mset.get_matches_upper_bound()]
+            self._cache_set(key, bounds)
+        return tuple(bounds)
+
+    def count(self, query_string, exact=False, at_least=0):
+        """Count documents matching search terms.
+
+        Returns the estimated number of matches, which is exact if
+        there are no more than `at_least` matches, or if `exact` is
+        True.  See count_bounds().
+
+        """
+        return self.count_bounds(query_string, exact=exact, at_least=at_least)[1]
+
+    # generator of ids of documents indexed with term, straight from
+    # the posting list without any weighting
+    def _docid_iter(self, term):
+        for post in self.xapian.postlist(term):
+            yield post.docid
+
+    def facets(self, query_string, names=None):
+        """Count facet values of documents matching search terms.
+
+        `names` is a list of facets to count, from Database.FACETS
+        (default is all).  Returns a dictionary keyed by facet name of
+        dictionaries of document counts keyed by facet value.
+
+        """
+        if not names:
+            names = self.FACETS
+        for name in names:
+            if name not in self.FACETS:
+                raise ValueError("unknown facet: %s" % name)
+
+        counts = {}
+        spy_names = []
+        for name in names:
+            # for all documents, term facets are just the term
+            # frequencies
+            if query_string == '*' and name in ['tag', 'source']:
+                prefix = self._find_prefix(name)
+                counts[name] = dict(
+                    (value, self.xapian.get_termfreq(util.get_full_term(prefix, value)))
+                    for value in self._term_iter(prefix))
+            elif query_string == '*' and name == 'sid':
+                counts[name] = dict(
+                    (sid, self.xapian.get_termfreq(self._source_term(sid)))
+                    for sid in self.sid_iter())
+            elif name != 'year':
+                spy_names.append(name)
+
+        if not spy_names and 'year' not in names:
+            return counts
+
+        enquire = self._enquire(query_string)
+        if spy_names:
+            spy = FacetSpy(self, spy_names)
+            enquire.add_matchspy(spy)
+        if 'year' in names:
+            year_spy = xapian.ValueCountMatchSpy(self._find_facet('year'))
+            enquire.add_matchspy(year_spy)
+        # check all matches, so that the spies see every document
+        enquire.get_mset(0, 0, self.xapian.get_doccount())
+
+        if spy_names:
+            for name, counter in spy.counts.items():
+                counts[name] = dict(counter)
+        if 'year' in names:
+            counts['year'] = {}
+            for item in year_spy.values():
+                year = int(xapian.sortable_unserialise(item.term))
+                counts['year'][str(year)] = item.termfreq
+        return counts
+
+    def _doc_for_term(self, term, desc):
+        docids = list(itertools.islice(self._docid_iter(term), 2))
+        if len(docids) > 1:
+            raise DatabaseAmbiguityError("Multiple documents found for %s." % desc)
+        if docids:
+            return self[docids[0]]
         else:
             return None
 
+    # return dictionary of lists of documents for each term
+    def _docs_for_terms(self, terms):
+        docs = {}
+        # look up terms in order, for locality in the term index
+        for term in sorted(set(terms)):
+            docs[term] = [self[docid] for docid in self._docid_iter(term)]
+        return docs
+
+    def _source_term(self, sid):
+        source, oid = sid.split(':', 1)
+        return util.get_full_term(self._make_source_prefix(source), oid)
+
+    def _bib_term(self, bibkey):
+        return util.get_full_term(self._find_prefix('key'), bibkey)
+
     def doc_for_path(self, path):
-        """Return document for specified path."""
-        term = self._find_prefix('file') + path
-        return self._doc_for_term(term)
+        """Return document for specified path.
+
+        Raises DatabaseAmbiguityError if more than one document
+        matches.
+
+        """
+        term = util.get_full_term(self._find_prefix('file'), path)
+        return self._doc_for_term(term, "file '%s'" % path)
+
+    def docs_for_hash(self, digest):
+        """Return list of documents with a file of SHA-256 hex digest."""
+        term = util.get_full_term(self._find_prefix('hash'), digest)
+        return [self[docid] for docid in self._docid_iter(term)]
 
     def doc_for_source(self, sid):
-        """Return document for source id string."""
-        source, oid = sid.split(':', 1)
-        term = self._make_source_prefix(source) + oid
-        return self._doc_for_term(term)
+        """Return document for source id string.
+
+        Raises DatabaseAmbiguityError if more than one document
+        matches.
+
+        """
+        return self._doc_for_term(self._source_term(sid), "source '%s'" % sid)
 
     def doc_for_bib(self, bibkey):
-        """Return document for bibtex key."""
-        term = self._find_prefix('key') + bibkey
-        return self._doc_for_term(term)
+        """Return document for bibtex key.
+
+        Raises DatabaseAmbiguityError if more than one document
+        matches.
+
+        """
+        return self._doc_for_term(self._bib_term(bibkey), "bibtex key '%s'" % bibkey)
+
+    def docs_for_sources(self, sids):
+        """Return documents for a list of source id strings.
+
+        Returns a dictionary keyed by sid of lists of matching
+        documents.  More than one document in a list indicates an
+        ambiguous sid.
+
+        """
+        terms = dict((sid, self._source_term(sid)) for sid in sids)
+        docs = self._docs_for_terms(terms.values())
+        return dict((sid, docs[term]) for sid, term in terms.items())
+
+    def docs_for_bibs(self, bibkeys):
+        """Return documents for a list of bibtex keys.
+
+        Returns a dictionary keyed by bibtex key of lists of matching
+        documents.  More than one document in a list indicates an
+        ambiguous key.
+
+        """
+        terms = dict((key, self._bib_term(key)) for key in bibkeys)
+        docs = self._docs_for_terms(terms.values())
+        return dict((key, docs[term]) for key, term in terms.items())
 
     ########################################
 
     def replace_document(self, docid, doc):
         """Replace (sync) document to database."""
-        self.xapian.replace_document(docid, doc)
+        self._writer.replace_document(docid, doc)
 
     def delete_document(self, docid):
         """Delete document from database."""
-        self.xapian.delete_document(docid)
+        self._writer.delete_document(docid)
 
     ########################################
 
-    def restore(self, log=False):
-        """Restore a database from an existing root."""
-        docdirs = os.listdir(self.root)
-        docdirs.sort()
-        for ddir in docdirs:
+    def restore(self, log=False, workers=None, batch_size=1000):
+        """Restore a database from an existing root.
+
+        Restore is a pipeline: docdirs found in the root are handed to
+        a pool of `workers` processes (default XAPERS_WORKERS, or the
+        number of CPUs), which parse the bibtex and document files and
+        build complete documents.  This process inserts the documents
+        as they are ready, committing every `batch_size` documents.
+        Docdirs are left as they are.  If `log` is True, progress and
+        throughput are reported to stderr.  Returns the number of
+        documents restored.
+
+        If a single shard is writable, only the documents belonging to
+        that shard are restored.
+
+        """
+        if not workers:
+            workers = int(os.getenv('XAPERS_WORKERS', 0)) or os.cpu_count() or 1
+
+        count = 0
+        start = time.monotonic()
+
+        def report():
+            elapsed = time.monotonic() - start
+            print('restored %d documents in %.1fs (%.1f docs/s)'
+                  % (count, elapsed, count / elapsed if elapsed else 0),
+                  file=sys.stderr)
+
+        # workers are spawned, rather than forked, so that they don't
+        # inherit the open writable database
+        ctx = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=ctx,
+                initializer=_restore_init, initargs=(self.root,)) as pool:
+            pending = collections.deque()
+            try:
+                for docdir in itertools.chain(self._root_docdirs(), [None]):
+                    if docdir:
+                        pending.append(pool.submit(_restore_docdir, *docdir))
+                    # keep a bounded number of documents in flight,
+                    # and insert the rest once all have been submitted
+                    while pending and (not docdir or len(pending) >= 4 * workers):
+                        docid, data = pending.popleft().result()
+                        if log:
+                            print('  id:%d' % docid, file=sys.stderr)
+                        self.replace_document(docid, xapian.Document.unserialise(data))
+                        count += 1
+                        if count % batch_size == 0:
+                            self._writer.commit()
+                            if log:
+                                report()
+            except:
+                for future in pending:
+                    future.cancel()
+                raise
+        self._writer.commit()
+        if log:
+            report()
+        return count
+
+    # iterate over (docid, docdir, docfiles) tuples of the non-empty
+    # docdirs in the root belonging to writable shards
+    def _root_docdirs(self):
+        for ddir in sorted(os.listdir(self.root)):
             docdir = os.path.join(self.root, ddir)
 
             # skip things that aren't directories
             if not os.path.isdir(docdir):
                 continue
 
-            # if we can't convert the directory name into an integer,
-            # assume it's not relevant to us and continue
+            # if we can't convert the directory name into an
+            # integer, assume it's not relevant to us and continue
             try:
                 docid = int(ddir)
             except ValueError:
                 continue
 
-            if log:
-                print(docdir, file=sys.stderr)
+            if not self._in_shard(docid):
+                continue
 
             docfiles = os.listdir(docdir)
             if not docfiles:
                 # skip empty directories
                 continue
 
-            if log:
-                print('  docid:', docid, file=sys.stderr)
+            yield docid, docdir, docfiles
+
+    # paths of the document files in (docid, docdir, docfiles) tuples
+    def _docdir_paths(self, docdirs):
+        for docid, docdir, docfiles in docdirs:
+            for dfile in docfiles:
+                if dfile not in ['bibtex', 'tags']:
+                    yield os.path.join(docdir, dfile)
+
+    # index the files in a document's docdir, with file text from the
+    # `texts` ParsePool if provided
+    def _index_docdir(self, doc, docfiles, log=False, texts=None):
+        for dfile in docfiles:
+            dpath = os.path.join(doc.docdir, dfile)
+            if dfile == 'bibtex':
+                if log:
+                    print('  adding bibtex', file=sys.stderr)
+                doc.add_bibtex(dpath)
+            elif dfile == 'tags':
+                if log:
+                    print('  adding tags', file=sys.stderr)
+                with open(dpath, 'r') as f:
+                    tags = f.read().strip().split('\n')
+                doc.add_tags(tags)
+            else: #elif os.path.splitext(dpath)[1] == '.pdf':
+                if log:
+                    print('  adding file:', dfile, file=sys.stderr)
+                text = texts.get(dpath) if texts else None
+                doc.add_file(dpath, text=text)
+
+    def reindex(self, log=False, changed=False, batch_size=1000):
+        """Reindex all documents from their docdirs.
+
+        All terms of each document are regenerated, applying the
+        current indexing policy (see set_positions()).  Documents
+        without docdirs are left as they are.  Changes are committed
+        every `batch_size` documents.  Database must be writable.
+
+        If `changed` is True, only docdirs whose contents have changed
+        since the last such reindex are reindexed, according to a
+        manifest of the mtime, size and hash of each docdir file.
+        Files are only hashed if their mtime or size has changed.
+        New docdirs in the root are indexed, and documents whose
+        docdirs have been removed are deleted.
+
+        Returns a tuple of the number of documents reindexed and
+        deleted.
 
+        """
+        docids = [docid for docid in self._docid_iter('') if self._in_shard(docid)]
+        if changed:
+            old = self._load_manifest()
+            manifest = {}
+            indexed = set(docids)
+            for ddir in os.listdir(self.root):
+                if ddir.isdigit() and self._in_shard(int(ddir)):
+                    docids.append(int(ddir))
+            docids = sorted(set(docids))
+
+        docdirs = []
+        removed = []
+        for docid in docids:
+            docdir = os.path.join(self.root, '%010d' % docid)
             try:
-                doc = self[docid]
-            except xapian.DocNotFoundError:
-                doc = Document(self, docid=docid)
+                docfiles = os.listdir(docdir)
+            except (FileNotFoundError, NotADirectoryError):
+                if changed and docid in indexed:
+                    removed.append(docid)
+                continue
+            if changed:
+                key = str(docid)
+                entry = self._docdir_manifest(docdir, docfiles, old.get(key, {}))
+                manifest[key] = entry
+                # unchanged if the same files have the same contents
+                if docid in indexed and key in old \
+                   and {n: e[1:] for n, e in entry.items()} \
+                   == {n: e[1:] for n, e in old[key].items()}:
+                    continue
+                # skip new empty directories
+                if docid not in indexed and not docfiles:
+                    continue
+            docdirs.append((docid, docdir, docfiles))
+
+        with self.batch(size=batch_size), ParsePool(self._docdir_paths(docdirs)) as texts:
+            for docid, docdir, docfiles in docdirs:
+                if log:
+                    print('  id:%d' % docid, file=sys.stderr)
+                try:
+                    doc = self[docid]
+                    doc._clear()
+                except xapian.DocNotFoundError:
+                    doc = Document(self, docid=docid)
+                    doc._set_date('added', os.stat(docdir).st_mtime)
+                self._index_docdir(doc, docfiles, log=log, texts=texts)
+                # only the index has changed, not the document
+                doc.sync(touch=False)
+            for docid in removed:
+                if log:
+                    print('  id:%d: docdir removed, deleting' % docid, file=sys.stderr)
+                self.delete_document(docid)
+
+        if changed:
+            # the bibtex and tags files of synced documents have been
+            # rewritten, so record them as they are now
+            for docid, docdir, docfiles in docdirs:
+                key = str(docid)
+                manifest[key] = self._docdir_manifest(
+                    docdir, os.listdir(docdir), manifest[key])
+            self._save_manifest(manifest)
+
+        return len(docdirs), len(removed)
+
+    # manifest of docdir files, for reindex(changed=True).  the
+    # manifest maps docids to dictionaries of [mtime, size, hash]
+    # lists for each docdir file.  single shard writers keep their
+    # own manifest.
+    def _manifest_path(self):
+        if self.shard is None:
+            name = 'manifest'
+        else:
+            name = 'manifest.%d' % self.shard
+        return os.path.join(self.root, '.xapers', name)
 
-            for dfile in docfiles:
-                dpath = os.path.join(docdir, dfile)
-                if dfile == 'bibtex':
-                    if log:
-                        print('  adding bibtex', file=sys.stderr)
-                    doc.add_bibtex(dpath)
-                elif dfile == 'tags':
-                    if log:
-                        print('  adding tags', file=sys.stderr)
-                    with open(dpath, 'r') as f:
-                        tags = f.read().strip().split('\n')
-                    doc.add_tags(tags)
-                else: #elif os.path.splitext(dpath)[1] == '.pdf':
-                    if log:
-                        print('  adding file:', dfile, file=sys.stderr)
-                    doc.add_file(dpath)
-            doc.sync()
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path(), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest):
+        path = self._manifest_path()
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    # manifest entry for docfiles in docdir.  hashes are reused from
+    # the old entry for files with unchanged mtime and size.
+    def _docdir_manifest(self, docdir, docfiles, old):
+        entry = {}
+        for name in docfiles:
+            path = os.path.join(docdir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not os.path.isfile(path):
+                continue
+            prev = old.get(name)
+            if prev and prev[:2] == [st.st_mtime_ns, st.st_size]:
+                entry[name] = prev
+            else:
+                entry[name] = [st.st_mtime_ns, st.st_size, util.file_hash(path)]
+        return entry
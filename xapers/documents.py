@@ -19,13 +19,15 @@ Jameson Rollins <jrollins@finestructure.net>
 """
 
 import os
+import json
+import time
 import shutil
 import xapian
 
 from . import util
-from .parser import parse_data
+from .parser import parse_data, ParsedFile
 from .source import Sources
-from .bibtex import Bibtex
+from .bibtex import Bibtex, load_bibentry
 
 ##################################################
 
@@ -39,31 +41,99 @@ class DocumentError(Exception):
 ##################################################
 
 class Documents():
-    """Represents a set of Xapers documents given a Xapian mset."""
+    """Represents a set of Xapers documents matching a search.
 
-    def __init__(self, db, mset):
+    Matches are retrieved in pages of `page_size` documents as they
+    are accessed, starting at match `offset`, and up to `limit`
+    documents if specified.  Pages are read from the database search
+    cache if possible, and the query is only parsed and run on a
+    cache miss.
+
+    Searches of writable databases see uncommitted changes, so that
+    documents modified while iterating could move in or out of later
+    pages.  All matches of writable databases are therefore retrieved
+    in a single page on first access.
+
+    """
+
+    PAGE_SIZE = 100
+
+    def __init__(self, db, query_string, sort='relevance', offset=0, limit=None, page_size=None):
         self.db = db
-        self.mset = mset
+        self.query_string = query_string
+        self.sort = sort
+        self.offset = offset
+        self.limit = limit
+        self.page_size = page_size or self.PAGE_SIZE
+        if db.writable:
+            self.page_size = max(limit or db.xapian.get_doccount(), 1)
         self.index = -1
-        self.max = len(mset)
+        self.max = None
+        self._enquire = None
+        # current page of (docid, percent) matches
+        self._page = None
+        self._page_start = None
+
+    @property
+    def enquire(self):
+        if self._enquire is None:
+            self._enquire = self.db._enquire(self.query_string, sort=self.sort)
+        return self._enquire
+
+    def _get_mset(self, first, size):
+        try:
+            return self.enquire.get_mset(first, size)
+        except xapian.DatabaseModifiedError:
+            self.db.reopen()
+            return self.enquire.get_mset(first, size)
+
+    # return matches for the page starting at index
+    def _get_page(self, start):
+        if start != self._page_start:
+            size = self.page_size
+            if self.limit:
+                size = min(size, self.limit - start)
+            first = self.offset + start
+            key = ['page', self.query_string, self.sort, first, size]
+            page = self.db._cache_get(key)
+            if page is None:
+                page = [[m.docid, m.percent] for m in self._get_mset(first, size)]
+                self.db._cache_set(key, page)
+            self._page = page
+            self._page_start = start
+        return self._page
 
     def __getitem__(self, index):
-        m = self.mset[index]
-        doc = Document(self.db, m.document)
-        doc.matchp = m.percent
+        if index < 0 or (self.limit and index >= self.limit):
+            raise IndexError("document index out of range")
+        start = index - (index % self.page_size)
+        page = self._get_page(start)
+        if index - start >= len(page):
+            raise IndexError("document index out of range")
+        docid, percent = page[index - start]
+        doc = Document(self.db, self.db.xapian.get_document(docid))
+        doc.matchp = percent
         return doc
 
     def __iter__(self):
         return self
 
     def __len__(self):
+        if self.max is None:
+            # check all matches to get an exact count, without
+            # retrieving any
+            count = self.db.count(self.query_string, exact=True)
+            self.max = max(count - self.offset, 0)
+            if self.limit:
+                self.max = min(self.max, self.limit)
         return self.max
 
     def __next__(self):
         self.index = self.index + 1
-        if self.index == self.max:
+        try:
+            return self[self.index]
+        except IndexError:
             raise StopIteration
-        return self[self.index]
 
 ##################################################
 
@@ -97,7 +167,14 @@ class Document():
 
         self.bibentry = None
 
+        # display record, and whether terms have changed since load
+        self._record = None
+        self._terms_modified = False
+
+        # files to be written to the docdir at sync, as data by name,
+        # and as source paths by name
         self._infiles = {}
+        self._inpaths = {}
 
     def get_docid(self):
         """Return document id of document."""
@@ -114,9 +191,43 @@ class Document():
 
     def _write_files(self):
         for name, data in self._infiles.items():
-            path = os.path.join(self.docdir, name)
+            self._place_file(name, data=data)
+        for name, src in self._inpaths.items():
+            if not self._in_place(name):
+                self._place_file(name, src=src)
+
+    # place file src (or data) in the docdir, as a link to the blob
+    # store if in use.  existing files are replaced rather than
+    # overwritten, since they may be hard links.
+    def _place_file(self, name, src=None, data=None):
+        path = os.path.join(self.docdir, name)
+        if os.path.lexists(path):
+            os.remove(path)
+        if self.db.use_blobs:
+            if data is not None:
+                digest = util.data_hash(data)
+            else:
+                digest = util.file_hash(src)
+            blob = self.db._store_blob(digest, src=src, data=data)
+            try:
+                os.link(blob, path)
+                return
+            except OSError:
+                src, data = blob, None
+        if data is not None:
             with open(path, 'bw') as f:
                 f.write(data)
+        else:
+            util.place_file(src, path, hardlink=self.db.hardlink_files)
+
+    # whether the source of a file is already its docdir location
+    # (e.g. on restore)
+    def _in_place(self, name):
+        path = os.path.join(self.docdir, name)
+        try:
+            return os.path.samefile(self._inpaths[name], path)
+        except (KeyError, OSError):
+            return False
 
     def _write_bibfile(self):
         bibpath = self.get_bibpath()
@@ -141,15 +252,40 @@ class Document():
         if os.path.exists(self.docdir) and os.path.isdir(self.docdir):
             shutil.rmtree(self.docdir)
 
-    def sync(self):
-        """Sync document to database."""
-        # FIXME: add value for modification time
+    # names of the files written to the docdir by _write_docdir()
+    def _docdir_names(self):
+        paths = [name for name in self._inpaths if not self._in_place(name)]
+        return list(self._infiles) + paths + ['bibtex', 'tags']
+
+    def _write_docdir(self):
+        self._make_docdir()
+        self._write_files()
+        self._write_bibfile()
+        self._write_tagfile()
+        # files are only written once
+        self._infiles = {}
+        self._inpaths = {}
+
+    def sync(self, touch=True):
+        """Sync document to database.
+
+        If a database batch is open (see Database.batch()) the
+        document is indexed immediately, but writing the docdir is
+        held until the batch is committed.  The modified date is set
+        to now, unless `touch` is False (e.g. when only the index of
+        the document has changed).
+
+        """
         # FIXME: catch db not writable errors
+        self._set_dates(touch)
+        if self.db._batch:
+            self._set_record()
+            self.db.replace_document(self.docid, self.xapian_doc)
+            self.db._batch.add(self)
+            return
         try:
-            self._make_docdir()
-            self._write_files()
-            self._write_bibfile()
-            self._write_tagfile()
+            self._write_docdir()
+            self._set_record()
             self.db.replace_document(self.docid, self.xapian_doc)
         except:
             self._rm_docdir()
@@ -172,6 +308,7 @@ class Document():
     def _add_boolean_term(self, prefix, value):
         term = util.get_full_term(prefix, value)
         self.xapian_doc.add_boolean_term(term)
+        self._terms_modified = True
 
     # remove an individual prefix'd term for the document
     def _remove_term(self, prefix, value):
@@ -180,6 +317,7 @@ class Document():
             self.xapian_doc.remove_term(term)
         except xapian.InvalidArgumentError:
             pass
+        self._terms_modified = True
 
     # Parse 'text' and add a term to 'message' for each parsed
     # word. Each term will be added both prefixed (if prefix is not
@@ -187,12 +325,28 @@ class Document():
     # https://xapian.org/docs/bindings/python/
     # https://xapian.org/docs/quickstart.html
     # http://www.flax.co.uk/blog/2009/04/02/xapian-search-architecture/
-    def _gen_terms(self, prefix, text):
+    # index text of a field, with positional information (for phrase
+    # searches) only if the database indexing policy calls for it
+    def _gen_terms(self, prefix, text, field):
+        self._terms_modified = True
         term_gen = self.db.term_gen
         term_gen.set_document(self.xapian_doc)
+        if field in self.db.positions:
+            index_text = term_gen.index_text
+        else:
+            index_text = term_gen.index_text_without_positions
         if prefix:
-            term_gen.index_text(text, 1, prefix)
-        term_gen.index_text(text)
+            index_text(text, 1, prefix)
+        index_text(text)
+
+    # remove all terms (except the id), data and the display record,
+    # for reindexing
+    def _clear(self):
+        self.xapian_doc.clear_terms()
+        self._add_boolean_term(self.db._find_prefix('id'), self.docid)
+        self.xapian_doc.set_data('')
+        self.xapian_doc.remove_value(self.db._find_value('record'))
+        self._record = None
 
     # return a list of terms for prefix
     def _term_iter(self, prefix=None):
@@ -220,6 +374,76 @@ class Document():
         """Get data object for document."""
         return self.xapian_doc.get_data()
 
+    ########################################
+    # record
+
+    # The record is a compact json object of the document display
+    # metadata (title, authors, year, journal, key, urls, sids and
+    # tags), stored in a document value at sync() so that documents
+    # can be summarized without parsing the bibtex in the docdir.
+
+    def _get_record(self):
+        if self._record is None:
+            value = self.xapian_doc.get_value(self.db._find_value('record'))
+            if not value:
+                return None
+            self._record = json.loads(value)
+        return self._record
+
+    def _bib_record(self, bibentry):
+        fields = bibentry.get_fields()
+        record = {
+            'key': bibentry.key,
+            'authors': bibentry.get_authors(),
+            }
+        for field in ['title', 'year']:
+            if field in fields:
+                record[field] = fields[field]
+        # FIXME: this translation should be configurable
+        if 'journal' in fields:
+            record['journal'] = fields['journal']
+        elif 'container-title' in fields:
+            record['journal'] = fields['container-title']
+        elif 'arxiv' in fields:
+            record['journal'] = 'arXiv.org'
+        elif 'dcc' in fields:
+            record['journal'] = 'LIGO DCC'
+        urls = []
+        for field in ['url', 'adsurl']:
+            if field in fields:
+                urls.append(fields[field])
+        record['urls'] = urls
+        return record
+
+    def _set_record(self):
+        # the bibtex is only parsed if no record exists yet,
+        # otherwise the bib part of the existing record is kept
+        if not self.bibentry and self._get_record() is None:
+            self._load_bib()
+        if self.bibentry:
+            record = self._bib_record(self.bibentry)
+        else:
+            record = dict(self._get_record() or {})
+        record['sids'] = self._term_sids()
+        record['tags'] = list(self.term_iter('tag'))
+        value = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        self.xapian_doc.add_value(self.db._find_value('record'), value)
+        self._record = record
+        self._terms_modified = False
+
+    # return the record, if it's valid for the bib data of the
+    # document
+    def _bib_from_record(self):
+        if self.bibentry:
+            return None
+        return self._get_record()
+
+    # return the record, if it's valid for the terms of the document
+    def _terms_from_record(self):
+        if self._terms_modified:
+            return None
+        return self._get_record()
+
     ########################################
     # files
 
@@ -232,38 +456,56 @@ class Document():
         File will not copied into docdir until sync().
 
         """
-        # FIXME: set mime type term
-
         # parse the file data into text
         text = parse_data(data)
 
+        self._add_file_text(name, text)
+        self._add_file_hash(util.data_hash(data))
+
+        # add it to the cache to be written at sync()
+        self._inpaths.pop(name, None)
+        self._infiles[name] = data
+
+    def _add_file_text(self, name, text, summary=None):
+        # FIXME: set mime type term
+
         # generate terms from the text
-        self._gen_terms(None, text)
+        self._gen_terms(None, text, 'file')
 
         # set data to be text sample
         # FIXME: is this the right thing to put in the data?
-        summary = text[0:997] + '...'
+        if summary is None:
+            summary = text[0:997] + '...'
         self._set_data(summary)
 
         # FIXME: should files be renamed to something generic (0.pdf)?
         prefix = self.db._find_prefix('file')
         self._add_boolean_term(prefix, name)
 
-        # add it to the cache to be written at sync()
-        self._infiles[name] = data
+    def _add_file_hash(self, digest):
+        self._add_boolean_term(self.db._find_prefix('hash'), digest)
 
-    def add_file(self, infile):
+    def add_file(self, infile, text=None):
         """Add a file to document.
 
         Added file will have the same name.
 
-        File will not copied in to docdir until sync().
+        `infile` is a path or a ParsedFile.  The file is parsed from
+        its path, and not read into memory, unless it has already been
+        parsed or its `text` is provided (e.g. from a ParsePool).  It
+        will be copied (or linked) into the docdir at sync(), so it
+        should not be removed before then.
 
         """
-        with open(infile, 'br') as f:
-            data = f.read()
-        name = os.path.basename(infile)
-        self.add_file_data(name, data)
+        if not isinstance(infile, ParsedFile):
+            infile = ParsedFile(infile, text=text)
+        elif text is not None:
+            infile.text = text
+        name = infile.name
+        self._add_file_text(name, infile.text, infile.summary)
+        self._add_file_hash(infile.hash)
+        self._infiles.pop(name, None)
+        self._inpaths[name] = os.path.abspath(infile.path)
 
     def get_files(self):
         """Return files associated with document."""
@@ -301,14 +543,20 @@ class Document():
         # add a term for the sid, with source as prefix
         self._add_boolean_term(self.db._make_source_prefix(source), oid)
 
-    def get_sids(self):
-        """Return a list of sids for document."""
+    def _term_sids(self):
         sids = []
         for source in self.term_iter('source'):
             for oid in self._term_iter(self.db._make_source_prefix(source)):
                 sids.append('%s:%s' % (source, oid))
         return sids
 
+    def get_sids(self):
+        """Return a list of sids for document."""
+        record = self._terms_from_record()
+        if record is not None:
+            return list(record['sids'])
+        return self._term_sids()
+
     # TAGS
     def add_tags(self, tags):
         """Add tags from list to document."""
@@ -318,6 +566,9 @@ class Document():
 
     def get_tags(self):
         """Return a list of tags associated with document."""
+        record = self._terms_from_record()
+        if record is not None:
+            return list(record['tags'])
         return list(self.term_iter('tag'))
 
     def remove_tags(self, tags):
@@ -334,7 +585,7 @@ class Document():
         # FIXME: what's the clean way to get these prefixes?
         for term in self._term_iter('ZS'):
             self._remove_term('ZS', term)
-        self._gen_terms(pt, title)
+        self._gen_terms(pt, title, 'title')
 
     # AUTHOR
     def _set_authors(self, authors):
@@ -344,7 +595,7 @@ class Document():
         # FIXME: what's the clean way to get these prefixes?
         for term in self._term_iter('ZA'):
             self._remove_term('ZA', term)
-        self._gen_terms(pa, authors)
+        self._gen_terms(pa, authors, 'author')
 
     # YEAR
     def _set_year(self, year):
@@ -360,6 +611,35 @@ class Document():
         facet = self.db._find_facet('year')
         self.xapian_doc.add_value(facet, xapian.sortable_serialise(year))
 
+    # DATES
+    def _set_date(self, name, timestamp):
+        facet = self.db._find_facet(name)
+        self.xapian_doc.add_value(facet, xapian.sortable_serialise(timestamp))
+
+    def _get_date(self, name):
+        value = self.xapian_doc.get_value(self.db._find_facet(name))
+        if value:
+            return xapian.sortable_unserialise(value)
+
+    def _set_dates(self, touch=True):
+        now = time.time()
+        if self.get_added() is None:
+            self._set_date('added', now)
+        # documents without a modified date were last modified when
+        # added
+        if touch:
+            self._set_date('modified', now)
+        elif self.get_modified() is None:
+            self._set_date('modified', self.get_added())
+
+    def get_added(self):
+        """Get time document was added, in seconds since the epoch."""
+        return self._get_date('added')
+
+    def get_modified(self):
+        """Get time document was last modified, in seconds since the epoch."""
+        return self._get_date('modified')
+
     ########################################
     # bibtex
 
@@ -405,9 +685,15 @@ class Document():
     def _load_bib(self):
         if self.bibentry:
             return
+        # bibtex for documents in an open batch may not have been
+        # written to the docdir yet
+        if self.db._batch:
+            self.bibentry = self.db._batch.get_bibentry(self.docid)
+            if self.bibentry:
+                return
         bibpath = self.get_bibpath()
         if os.path.exists(bibpath):
-            self.bibentry = Bibtex(bibpath)[0]
+            self.bibentry = load_bibentry(bibpath)
 
     def get_bibtex(self):
         """Get the bib for document as a bibtex string."""
@@ -433,7 +719,9 @@ class Document():
 
     def get_key(self):
         """Get the document key."""
-        # FIXME: get from facet not bib
+        record = self._bib_from_record()
+        if record is not None:
+            return record.get('key')
         self._load_bib()
         if not self.bibentry:
             return
@@ -441,6 +729,9 @@ class Document():
 
     def get_title(self):
         """Get document full title from bibtex."""
+        record = self._bib_from_record()
+        if record is not None:
+            return record.get('title')
         self._load_bib()
         if not self.bibentry:
             return
@@ -450,6 +741,9 @@ class Document():
 
     def get_authors(self):
         """Get document author(s) from bibtex."""
+        record = self._bib_from_record()
+        if record is not None:
+            return record.get('authors')
         self._load_bib()
         if not self.bibentry:
             return
@@ -457,7 +751,9 @@ class Document():
 
     def get_year(self):
         """Get document year from bibtex."""
-        # FIXME: get from facet not bib
+        record = self._bib_from_record()
+        if record is not None:
+            return record.get('year')
         self._load_bib()
         if not self.bibentry:
             return
@@ -465,6 +761,16 @@ class Document():
         if 'year' in fields:
             return fields['year']
 
+    def get_journal(self):
+        """Get document journal name from bibtex."""
+        record = self._bib_from_record()
+        if record is not None:
+            return record.get('journal')
+        self._load_bib()
+        if not self.bibentry:
+            return
+        return self._bib_record(self.bibentry).get('journal')
+
     def get_urls(self):
         """Get all URLs associated with document."""
         sources = Sources()
@@ -473,11 +779,11 @@ class Document():
         for sid in self.get_sids():
             urls.append(sources[sid].url)
         # get urls from bibtex
+        record = self._bib_from_record()
+        if record is not None:
+            urls += record.get('urls', [])
+            return urls
         self._load_bib()
         if self.bibentry:
-            fields = self.bibentry.get_fields()
-            if 'url' in fields:
-                urls.append(fields['url'])
-            if 'adsurl' in fields:
-                urls.append(fields['adsurl'])
+            urls += self._bib_record(self.bibentry)['urls']
         return urls
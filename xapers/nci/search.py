@@ -23,7 +23,7 @@ import urwid
 import subprocess
 import collections
 
-from ..cli import initdb
+from ..cli import initdb, apply_queue
 from ..database import DatabaseLockError, DatabaseModifiedError
 
 PALETTE = [
@@ -45,6 +45,10 @@ PALETTE = [
 
 ############################################################
 
+def tag_completions(db, limit=100):
+    """tag completion function for prompts"""
+    return lambda prefix: db.complete('tag', prefix, limit)
+
 def xdg_open(path):
     """open document file"""
     with open(os.devnull) as devnull:
@@ -100,28 +104,14 @@ class DocItem(urwid.WidgetWrap):
         field_data['tags'] = ' '.join(doc.get_tags())
         field_data['bibkey'] = doc.get_key() or ''
 
-        bibdata = doc.get_bibdata()
-        if bibdata:
-            for field, value in bibdata.items():
-                if 'title' == field:
-                    field_data[field] = value
-                elif 'authors' == field:
-                    field_data[field] = ' and '.join(value[:4])
-                    if len(value) > 4:
-                        field_data[field] += ' et al.'
-                elif 'year' == field:
-                    field_data[field] = value
-
-                # FIXME: this translation should not be done here
-                if field_data['journal'] == '':
-                    if 'journal' == field:
-                        field_data['journal'] = value
-                    elif 'container-title' == field:
-                        field_data['journal'] = value
-                    elif 'arxiv' == field:
-                        field_data['journal'] = 'arXiv.org'
-                    elif 'dcc' == field:
-                        field_data['journal'] = 'LIGO DCC'
+        field_data['title'] = doc.get_title() or ''
+        authors = doc.get_authors()
+        if authors:
+            field_data['authors'] = ' and '.join(authors[:4])
+            if len(authors) > 4:
+                field_data['authors'] += ' et al.'
+        field_data['year'] = doc.get_year() or ''
+        field_data['journal'] = doc.get_journal() or ''
 
         urls = doc.get_urls()
         if urls:
@@ -269,7 +259,7 @@ class DocItem(urwid.WidgetWrap):
         if sign == '-':
             completions = self.doc.get_tags()
         else:
-            completions = self.ui.db.get_tags()
+            completions = tag_completions(self.ui.db)
         self.ui.prompt((self.applyTags, []),
                        prompt, initial=initial,
                        completions=completions,
@@ -279,37 +269,45 @@ class DocItem(urwid.WidgetWrap):
         if not tag_string:
             self.ui.set_status("No tags set.")
             return
+        tags_add = []
+        tags_sub = []
+        for tag in tag_string.split():
+            if tag[0] == '+':
+                if tag[1:]:
+                    tags_add.append(tag[1:])
+            elif tag[0] == '-':
+                tags_sub.append(tag[1:])
+            else:
+                tags_add.append(tag)
         try:
-            with initdb(writable=True) as db:
+            with initdb(writable=True, lock_error=True) as db:
                 doc = db[self.doc.docid]
-                for tag in tag_string.split():
-                    if tag[0] == '+':
-                        if tag[1:]:
-                            doc.add_tags([tag[1:]])
-                    elif tag[0] == '-':
-                        doc.remove_tags([tag[1:]])
-                    else:
-                        doc.add_tags([tag])
+                doc.add_tags(tags_add)
+                doc.remove_tags(tags_sub)
                 doc.sync()
                 msg = "applied tags: {}".format(tag_string)
             tags = doc.get_tags()
             self.tag_field.set_text(' '.join(tags))
-            if self.ui.tag_history and tag_string == self.ui.tag_history[-1]:
-                pass
-            else:
-                self.ui.tag_history.append(tag_string)
         except DatabaseLockError as e:
-            msg = e.msg
+            # queue for the lock holder to apply
+            self.ui.db.queue.put([self.doc.docid], tags_add, tags_sub)
+            msg = "{} queued tags: {}".format(e.msg, tag_string)
+            apply_queue(self.ui.db.root)
+        if self.ui.tag_history and tag_string == self.ui.tag_history[-1]:
+            pass
+        else:
+            self.ui.tag_history.append(tag_string)
         self.ui.db.reopen()
         self.ui.set_status(msg)
 
 ############################################################
 
 class DocWalker(urwid.ListWalker):
-    def __init__(self, ui, docs):
+    def __init__(self, ui, docs, total):
         self.ui = ui
         self.docs = docs
-        self.ndocs = len(docs)
+        # total count string for display, possibly an estimate
+        self.total = total
         self.focus = 0
         self.items = {}
 
@@ -317,12 +315,12 @@ class DocWalker(urwid.ListWalker):
         if pos < 0:
             raise IndexError
         if pos not in self.items:
-            self.items[pos] = DocItem(self.ui, self.docs[pos], pos+1, self.ndocs)
+            self.items[pos] = DocItem(self.ui, self.docs[pos], pos+1, self.total)
         return self.items[pos]
 
     def set_focus(self, focus):
         if focus == -1:
-            focus = self.ndocs - 1
+            focus = len(self.docs) - 1
         self.focus = focus
         self._modified()
 
@@ -357,7 +355,7 @@ class Search(urwid.Frame):
         ('=', "refresh"),
         ])
 
-    __sort = collections.deque(['relevance', 'year'])
+    __sort = collections.deque(['relevance', 'year', 'added', 'modified'])
 
     def __init__(self, ui, query=None):
         self.ui = ui
@@ -375,18 +373,24 @@ class Search(urwid.Frame):
 
     def __set_search(self):
         try:
-            count = self.ui.db.count(self.query)
+            lower, count, upper = self.ui.db.count_bounds(self.query)
         except DatabaseModifiedError:
             self.ui.db.reopen()
-        if count == 0:
+            lower, count, upper = self.ui.db.count_bounds(self.query)
+        if upper == 0:
             self.ui.set_status('No documents found.')
             docs = []
         else:
-            docs = [doc for doc in self.ui.db.search(self.query, sort=self.sort_order)]
+            docs = self.ui.db.search(self.query, sort=self.sort_order)
+        # the count is only estimated if the bounds differ
+        if lower == upper:
+            total = "%d" % (count)
+        else:
+            total = "~%d" % (count)
         if count == 1:
-            cstring = "%d result" % (count)
+            cstring = "%s result" % (total)
         else:
-            cstring = "%d results" % (count)
+            cstring = "%s results" % (total)
 
         htxt = [('pack', urwid.Text("Search: ")),
                 ('pack', urwid.AttrMap(urwid.Text("%s" % (self.query), align='left'), 'header_args')),
@@ -396,8 +400,7 @@ class Search(urwid.Frame):
         header = urwid.AttrMap(urwid.Columns(htxt), 'header')
         self.set_header(header)
 
-        self.lenitems = count
-        self.docwalker = DocWalker(self.ui, docs)
+        self.docwalker = DocWalker(self.ui, docs, total)
         self.listbox = urwid.ListBox(self.docwalker)
         body = self.listbox
         self.set_body(body)
@@ -438,7 +441,7 @@ class Search(urwid.Frame):
         # rather than resetting to the top
 
     def toggleSort(self, size, key):
-        """toggle search sort order between year/relevance"""
+        """cycle search sort order (relevance/year/added/modified)"""
         self.__sort.rotate()
         self.__set_search()
 
@@ -458,7 +461,7 @@ class Search(urwid.Frame):
         """next entry"""
         entry, pos = self.listbox.get_focus()
         if not entry: return
-        if pos + 1 >= self.lenitems: return
+        if not self.docwalker.get_next(pos)[0]: return
         self.listbox.set_focus(pos + 1)
 
     def prevEntry(self, size, key):
@@ -508,7 +511,7 @@ class Search(urwid.Frame):
         """tag all documents in current search"""
         prompt = "tag all (+add -remove): "
         initial = ''
-        completions = self.ui.db.get_tags()
+        completions = tag_completions(self.ui.db)
         self.ui.prompt((self.applyTags, []),
                        prompt, initial=initial,
                        completions=completions,
@@ -529,16 +532,22 @@ class Search(urwid.Frame):
             else:
                 tags_add.append(tag)
         try:
-            with initdb(writable=True) as db:
-                count = db.count(self.query)
-                for doc in db.search(self.query):
-                    doc.add_tags(tags_add)
-                    doc.remove_tags(tags_sub)
-                    doc.sync()
+            with initdb(writable=True, lock_error=True) as db:
+                count = 0
+                with db.batch():
+                    for doc in db.search(self.query):
+                        doc.add_tags(tags_add)
+                        doc.remove_tags(tags_sub)
+                        doc.sync()
+                        count += 1
             msg = "applied tags to {} docs: {}".format(count, tag_string)
-            if not self.ui.tag_history or tag_string != self.ui.tag_history[-1]:
-                self.ui.tag_history.append(tag_string)
         except DatabaseLockError as e:
-            msg = e.msg
+            # queue for the lock holder to apply
+            docids = [doc.docid for doc in self.ui.db.search(self.query)]
+            self.ui.db.queue.put(docids, tags_add, tags_sub)
+            msg = "{} queued tags for {} docs: {}".format(e.msg, len(docids), tag_string)
+            apply_queue(self.ui.db.root)
+        if not self.ui.tag_history or tag_string != self.ui.tag_history[-1]:
+            self.ui.tag_history.append(tag_string)
         self.refresh(None, None)
         self.ui.set_status(msg)
@@ -314,11 +314,15 @@ class PromptEdit(urwid.Edit, metaclass=urwid.signals.MetaSignals):
                     self.completion_data['q'].rotate(-1)
             else:
                 self.completion_data['prefix'] = prefix
-                # harvest completions
-                q = collections.deque()
-                for c in self.completions:
-                    if c.startswith(prefix):
-                        q.append(c)
+                # harvest completions, from a completion function
+                # if provided
+                if callable(self.completions):
+                    q = collections.deque(self.completions(prefix))
+                else:
+                    q = collections.deque()
+                    for c in self.completions:
+                        if c.startswith(prefix):
+                            q.append(c)
                 self.completion_data['q'] = q
 
             logging.debug(self.completion_data)
@@ -19,31 +19,65 @@ Jameson Rollins <jrollins@finestructure.net>
 """
 
 import os
+import concurrent.futures
+
+from . import util
 
 class ParseError(Exception):
     pass
 
-def parse_data(data, mimetype='pdf'):
-    """Parse binary data of specified mime type into text (str)
+# optional cache of extracted text (a cache.TextCache), set with
+# set_text_cache()
+_text_cache = None
 
-    """
+def set_text_cache(cache):
+    """Set cache of extracted text, or None to disable caching."""
+    global _text_cache
+    _text_cache = cache
 
+def _get_parser(mimetype):
     try:
-        mod = __import__('xapers.parsers.' + mimetype, fromlist=['Parser'])
-        parse_func = getattr(mod, 'parse')
+        return __import__('xapers.parsers.' + mimetype, fromlist=['Parser'])
     except ImportError:
         raise ParseError("Unsupported mime type '%s'." % mimetype)
 
+def _parser_id(mod, mimetype):
+    # parsers bump their VERSION when their output changes, so that
+    # text cached from older versions is not used
+    return '%s.%s' % (mimetype, getattr(mod, 'VERSION', 0))
+
+def parse_data(data, mimetype='pdf'):
+    """Parse binary data of specified mime type into text (str)
+
+    """
+
+    mod = _get_parser(mimetype)
+
+    if _text_cache:
+        digest = util.data_hash(data)
+        parser = _parser_id(mod, mimetype)
+        text = _text_cache.get(digest, parser)
+        if text is not None:
+            return text
+
     try:
-        text = parse_func(data)
+        text = mod.parse(data)
     except Exception as e:
         raise ParseError("Could not parse file: %s" % e)
 
+    if _text_cache:
+        _text_cache.set(digest, parser, text)
+
     return text
 
-def parse_file(path):
+def parse_file(path, mimetype='pdf', digest=None):
     """Parse file for text (str)
 
+    Parsers that can read directly from the file do so, so that the
+    file is not read into memory.  Text is taken from the text cache,
+    if set and the file has been parsed before.  The content hash of
+    the file is used if provided in `digest`, rather than computed.
+
     """
 
     # FIXME: determine mime type
@@ -54,7 +88,164 @@ def parse_file(path):
     if not os.path.isfile(path):
         raise ParseError("File '%s' is not a regular file." % path)
 
-    with open(path, 'br') as f:
-        data = f.read()
+    mod = _get_parser(mimetype)
+    if not hasattr(mod, 'parse_file'):
+        with open(path, 'br') as f:
+            data = f.read()
+        return parse_data(data, mimetype)
+
+    if _text_cache:
+        if not digest:
+            digest = util.file_hash(path)
+        parser = _parser_id(mod, mimetype)
+        text = _text_cache.get(digest, parser)
+        if text is not None:
+            return text
+
+    try:
+        text = mod.parse_file(path)
+    except Exception as e:
+        raise ParseError("Could not parse file: %s" % e)
+
+    if _text_cache:
+        _text_cache.set(digest, parser, text)
+
+    return text
+
+
+class ParsedFile():
+    """Document file, parsed at most once for all of its uses.
+
+    The text, content hash and summary of the file at `path` are
+    computed when first needed and kept, so that e.g. scanning the
+    file for source identifiers and indexing it share a single parse.
+    `text` may be provided if already known (e.g. from a ParsePool).
+    The source items found in the file are kept in `sids` by
+    Sources.scan_file().
+
+    """
+
+    def __init__(self, path, text=None, mimetype='pdf'):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.mimetype = mimetype
+        self._text = text
+        self._hash = None
+        self.sids = None
+
+    @property
+    def parsed(self):
+        """True if the file text is known."""
+        return self._text is not None
+
+    @property
+    def text(self):
+        """Text of file, as parse_file()."""
+        if self._text is None:
+            # the content hash is only needed for the text cache
+            digest = self.hash if _text_cache else self._hash
+            self._text = parse_file(self.path, self.mimetype, digest=digest)
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+
+    @property
+    def hash(self):
+        """Hex SHA-256 digest of file contents."""
+        if self._hash is None:
+            try:
+                self._hash = util.file_hash(self.path)
+            except FileNotFoundError:
+                raise ParseError("File '%s' not found." % self.path)
+            except IsADirectoryError:
+                raise ParseError("File '%s' is not a regular file." % self.path)
+        return self._hash
+
+    @property
+    def size(self):
+        """Size of file in bytes."""
+        return os.path.getsize(self.path)
+
+    @property
+    def summary(self):
+        """Sample of file text, for document data."""
+        return self.text[0:997] + '...'
+
+
+class ParsePool():
+    """Parse files in parallel, ahead of their use.
+
+    The files in `paths` are parsed in order by a pool of `workers`
+    threads (parsers run external programs, so threads are enough),
+    keeping at most twice that many files parsed or in progress ahead
+    of those retrieved with get().  This lets a single database writer
+    index one file while the next ones are parsed.  `paths` may be a
+    lazy iterator, which is only consumed as far as needed, and may
+    include ParsedFile objects, which keep their text and hash.  The
+    number of workers defaults to XAPERS_WORKERS, or the number of
+    CPUs.
+
+    Should be used as a context manager.
+
+    """
 
-    return parse_data(data)
+    def __init__(self, paths, workers=None):
+        if not workers:
+            workers = int(os.getenv('XAPERS_WORKERS', 0)) or os.cpu_count() or 1
+        self.workers = workers
+        self._paths = iter(paths)
+        self._futures = {}
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self._fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _fill(self):
+        while len(self._futures) < 2 * self.workers:
+            path = next(self._paths, None)
+            if path is None:
+                break
+            if isinstance(path, ParsedFile):
+                pfile = path
+                path = pfile.path
+                if path not in self._futures:
+                    self._futures[path] = self._pool.submit(getattr, pfile, 'text')
+            elif path not in self._futures:
+                self._futures[path] = self._pool.submit(parse_file, path)
+
+    def add(self, path):
+        """Start parsing file now, in addition to `paths`.
+
+        The number of files added is up to the caller.
+
+        """
+        if path not in self._futures:
+            self._futures[path] = self._pool.submit(parse_file, path)
+
+    def get(self, path):
+        """Return text of file, as parse_file().
+
+        Files that weren't queued, or not yet, are parsed directly.
+
+        """
+        future = self._futures.pop(path, None)
+        if future:
+            try:
+                return future.result()
+            finally:
+                self._fill()
+        return parse_file(path)
+
+    def close(self):
+        """Cancel outstanding parses and shut down the pool."""
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._paths = iter(())
+        self._pool.shutdown()
@@ -1,12 +1,26 @@
 import subprocess
 
+# bump when output changes, so that cached text is not used
+VERSION = 1
+
 def parse(data):
     cmd = ['pdftotext', '-', '-']
     proc = subprocess.Popen(cmd,
                             stdin=subprocess.PIPE,
                             stdout=subprocess.PIPE,
-                            stderr=open('/dev/null','w'),
+                            stderr=subprocess.DEVNULL,
                             )
     (stdout, stderr) = proc.communicate(input=data)
     proc.wait()
     return stdout.decode()
+
+def parse_file(path):
+    cmd = ['pdftotext', path, '-']
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            )
+    (stdout, stderr) = proc.communicate()
+    proc.wait()
+    return stdout.decode()
@@ -21,10 +21,11 @@ Jameson Rollins <jrollins@finestructure.net>
 import os
 import re
 import pkgutil
+import importlib.util
 from urllib.parse import urlparse
 
 from . import sources
-from .parser import parse_file
+from .parser import ParsedFile
 
 ##################################################
 
@@ -43,16 +44,19 @@ class SourceAttributeError(SourceError):
 class Source(object):
     """Xapers class representing an online document source.
 
-    The Source object is build from a source nickname (name) and
-    possibly user-defined source module.
+    The Source object is build from a source nickname (name) and the
+    module spec of a possibly user-defined source module.  The module
+    is not loaded until it is first needed.
 
     """
-    def __init__(self, name, module):
+    def __init__(self, name, spec):
         self.name = name
-        self.module = module
+        self.spec = spec
+        self._module = None
+        self._mtime = None
 
     def __repr__(self):
-        return '%s(%s, %s)' % (self.__class__, self.name, self.module)
+        return '%s(%s, %s)' % (self.__class__, self.name, self.path)
 
     def __str__(self):
         return self.name
@@ -60,9 +64,23 @@ class Source(object):
     def __getitem__(self, id):
         return SourceItem(self, id)
 
+    @property
+    def module(self):
+        # (re)load the module if it's not loaded or has been modified
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = self._mtime
+        if self._module is None or mtime != self._mtime:
+            module = importlib.util.module_from_spec(self.spec)
+            self.spec.loader.exec_module(module)
+            self._module = module
+            self._mtime = mtime
+        return self._module
+
     @property
     def path(self):
-        return self.module.__file__
+        return self.spec.origin
 
     @property
     def is_builtin(self):
@@ -117,7 +135,8 @@ class SourceItem(Source):
 
     """
     def __init__(self, source, id):
-        super(SourceItem, self).__init__(source.name, source.module)
+        super(SourceItem, self).__init__(source.name, source.spec)
+        self.source = source
         self.id = id
         self.sid = '%s:%s' % (self.name, self.id)
 
@@ -139,6 +158,10 @@ class SourceItem(Source):
     def __str__(self):
         return self.sid
 
+    @property
+    def module(self):
+        return self.source.module
+
     @property
     def url(self):
         try:
@@ -154,24 +177,197 @@ class SourceItem(Source):
 
 ##################################################
 
+class SourceScanner(object):
+    """Scanner of text for source identifiers.
+
+    The 'scan_regex' patterns of all `sources` are compiled into a
+    single regex of lookaheads, so that text is scanned in one pass
+    for the positions where any source matches.  Every pattern is then
+    matched at those positions, so that, as with separate scans,
+    matches of different sources may overlap, while matches of the
+    same source do not.  Patterns that can't be combined (e.g. with
+    numbered back-references or inline flags) are scanned separately.
+
+    """
+    # length of text held back between streamed chunks, so that
+    # identifiers split across chunks are not truncated
+    OVERLAP = 1024
+
+    def __init__(self, sources):
+        self.patterns = []
+        for source in sources:
+            try:
+                self.patterns.append((source, source.scan_regex))
+            except SourceAttributeError:
+                # FIXME: warning?
+                continue
+
+        # (source, regex) tuples of the combined patterns, and of the
+        # patterns scanned separately
+        self._combined = []
+        self._separate = []
+        alts = []
+        for source, pattern in self.patterns:
+            regex = re.compile(pattern)
+            if not re.search(r'\\[1-9]', pattern):
+                alt = '(?=%s)' % pattern
+                try:
+                    re.compile('|'.join(alts + [alt]))
+                except re.error:
+                    pass
+                else:
+                    alts.append(alt)
+                    self._combined.append((source, regex))
+                    continue
+            self._separate.append((source, regex))
+        self._candidates = re.compile('|'.join(alts)) if alts else None
+
+    def _matches(self, text):
+        # iterate over (source, start, end, id) tuples of matches
+        def found(source, regex, m):
+            id = m.group(1) if regex.groups else m.group(0)
+            return source, m.start(), m.end(), id
+        if self._candidates:
+            for c in self._candidates.finditer(text):
+                for source, regex in self._combined:
+                    m = regex.match(text, c.start())
+                    if m:
+                        yield found(source, regex, m)
+        for source, regex in self._separate:
+            for m in regex.finditer(text):
+                yield found(source, regex, m)
+
+    def _scan(self, text, offset, final, items, ends):
+        # add items found in text, which starts at offset in the
+        # stream, to items.  unless final, matches that reach the
+        # held back end of the text may be incomplete, and are left
+        # for the next chunk.  ends holds the stream offset of the
+        # end of the last match of each source.  returns the index
+        # of the text to keep for the next chunk.
+        limit = len(text) if final else max(len(text) - self.OVERLAP, 0)
+        keep = limit
+        deferred = set()
+        for source, start, end, id in sorted(self._matches(text),
+                                             key=lambda m: m[1]):
+            if source.name in deferred:
+                continue
+            if not final and end > limit:
+                deferred.add(source.name)
+                keep = min(keep, start)
+                continue
+            if offset + start < ends.get(source.name, 0):
+                continue
+            ends[source.name] = offset + end
+            items.setdefault(source[id], None)
+        return keep
+
+    def scan_stream(self, chunks, pages=None, size=None):
+        """Scan iterable of text chunks for source identifiers.
+
+        Scanning stops after `pages` pages (delimited by form feeds,
+        as in pdftotext output) or `size` characters of text, if
+        specified.  Returns a list of SourceItem objects, in the order
+        found.
+
+        """
+        items = {}
+        ends = {}
+        text = ''
+        offset = 0
+        seen = 0
+        for chunk in chunks:
+            done = False
+            if size is not None and seen + len(chunk) >= size:
+                chunk = chunk[:size - seen]
+                done = True
+            if pages is not None:
+                index = -1
+                for i in range(pages):
+                    index = chunk.find('\f', index + 1)
+                    if index < 0:
+                        break
+                if index >= 0:
+                    chunk = chunk[:index]
+                    done = True
+                else:
+                    pages -= chunk.count('\f')
+            seen += len(chunk)
+            text += chunk
+            keep = self._scan(text, offset, done, items, ends)
+            if done:
+                text = ''
+                break
+            offset += keep
+            text = text[keep:]
+        if text:
+            self._scan(text, offset, True, items, ends)
+        return list(items)
+
+    def scan(self, text, pages=None, size=None):
+        """Scan text for source identifiers.
+
+        See scan_stream().
+
+        """
+        return self.scan_stream([text], pages=pages, size=size)
+
+##################################################
+
+def _path_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+# process-wide registry of sources for each source path, as
+# (path mtimes, sources dict) tuples
+_registry = {}
+
+# scanners for each source path, recompiled if the source patterns
+# change
+_scanners = {}
+
 class Sources(object):
+    """Xapers class representing the available sources.
+
+    Sources are found in the source path, and are shared by all
+    Sources objects in the process with the same path.  The source
+    path is rescanned only if one of its directories has been
+    modified, and source modules are only loaded when needed.
+
+    """
     def __init__(self):
-        self.sourcespath = sources.__path__
         extra = os.getenv('XAPERS_SOURCE_PATH', None)
         if extra:
-            for path in extra.split(':'):
-                if path:
-                    self.sourcespath.insert(0, path)
+            # later entries take precedence
+            path = [p for p in reversed(extra.split(':')) if p]
         else:
-            self.sourcespath.insert(0, os.path.expanduser(os.path.join('~','.xapers','sources')))
-
-        self._sources = {}
-        for (loader, name, ispkg) in pkgutil.walk_packages(self.sourcespath):
+            path = [os.path.expanduser(os.path.join('~','.xapers','sources'))]
+        self.sourcespath = path + list(sources.__path__)
+
+        key = tuple(self.sourcespath)
+        mtimes = [_path_mtime(p) for p in self.sourcespath]
+        cached_mtimes, self._sources = _registry.get(key, (None, {}))
+        if mtimes != cached_mtimes:
+            self._sources = self._find_sources(self._sources)
+            _registry[key] = (mtimes, self._sources)
+
+    def _find_sources(self, known):
+        # source modules are found but not loaded.  earlier path
+        # entries take precedence
+        found = {}
+        for (finder, name, ispkg) in pkgutil.iter_modules(self.sourcespath):
             if ispkg:
                 continue
-            #self._modules[name] = loader.find_module(name).load_module(name)
-            module = loader.find_module(name).load_module(name)
-            self._sources[name] = Source(name, module)
+            spec = finder.find_spec(name)
+            if not spec:
+                continue
+            # reuse known sources, with their loaded modules
+            source = known.get(name)
+            if not source or source.path != spec.origin:
+                source = Source(name, spec)
+            found[name] = source
+        return found
 
     def __repr__(self):
         return '%s(%s)' % (self.__class__, self.sourcespath)
@@ -227,27 +423,55 @@ class Sources(object):
         elif o.scheme != '' and o.path != '':
             return self.get_source(o.scheme, o.path)
 
-    def scan_file(self, file):
+    def scanner(self):
+        """Return SourceScanner for all sources.
+
+        The scanner is shared by all Sources objects with the same
+        source path, and only rebuilt if source patterns change.
+
+        """
+        key = tuple(self.sourcespath)
+        scanner = _scanners.get(key)
+        if scanner:
+            patterns = []
+            for source in self:
+                try:
+                    patterns.append((source, source.scan_regex))
+                except SourceAttributeError:
+                    continue
+            if patterns == scanner.patterns:
+                return scanner
+        scanner = SourceScanner(self)
+        _scanners[key] = scanner
+        return scanner
+
+    def scan_text(self, text, pages=None, size=None):
+        """Scan document text for source identifiers.
+
+        See SourceScanner.scan_stream().  Returns a list of SourceItem
+        objects.
+
+        """
+        return self.scanner().scan(text, pages=pages, size=size)
+
+    def scan_file(self, file, pages=None, size=None):
         """Scan document file for source identifiers
 
-        Source 'scan_regex' attributes are used.
-        Returns a list of SourceItem objects.
+        `file` is a path or a ParsedFile, which keeps its text and
+        the items found, so the file is only parsed and scanned once.
+        Source 'scan_regex' attributes are used, and scanning stops
+        after `pages` pages or `size` characters of text, if
+        specified.  Returns a list of SourceItem objects.
 
         """
-        text = parse_file(file)
-        items = set()
-        for source in self:
-            try:
-                regex = re.compile(source.scan_regex)
-            except SourceAttributeError:
-                # FIXME: warning?
-                continue
-            matches = regex.findall(text)
-            if not matches:
-                continue
-            for match in matches:
-                items.add(source[match])
-        return list(items)
+        if not isinstance(file, ParsedFile):
+            file = ParsedFile(file)
+        if file.sids is not None and pages is None and size is None:
+            return list(file.sids)
+        items = self.scan_text(file.text, pages=pages, size=size)
+        if pages is None and size is None:
+            file.sids = list(items)
+        return items
 
     def scan_bibentry(self, bibentry):
         """Scan bibentry for source identifiers.
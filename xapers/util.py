@@ -1,9 +1,15 @@
-def xapian_term_iter(xapian_object, prefix=None):
+import os
+import shutil
+import hashlib
+
+
+def xapian_term_iter(xapian_object, prefix=None, start=None):
     """Prefix term iterator for xapian objects
 
     `xapian_object` can be either a full database or a single
     document.  Iterates over all terms, or just those with prefix if
-    specified
+    specified.  If `start` is specified, iteration starts from the
+    first prefixed term at or after prefix+start
 
     """
     term_iter = iter(xapian_object)
@@ -22,7 +28,7 @@ def xapian_term_iter(xapian_object, prefix=None):
 
     if prefix:
         try:
-            term = term_iter.skip_to(prefix).term.decode()
+            term = term_iter.skip_to(prefix + (start or '')).term.decode()
         except StopIteration:
             return
         if not term.startswith(prefix):
@@ -49,3 +55,98 @@ def get_full_term(prefix, value):
         return '%s:%s' % (prefix, value)
     else:
         return '%s%s' % (prefix, value)
+
+
+def dir_size(path):
+    """Total size in bytes of all files under path"""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def exchange_paths(path1, path2):
+    """Atomically exchange two paths
+
+    Uses renameat2(RENAME_EXCHANGE) where available (Linux), so that
+    there is no moment when neither path exists.  Otherwise falls
+    back to a sequence of renames.
+
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        renameat2 = None
+    if renameat2:
+        AT_FDCWD = -100
+        RENAME_EXCHANGE = 2
+        if renameat2(AT_FDCWD, os.fsencode(path1),
+                     AT_FDCWD, os.fsencode(path2),
+                     RENAME_EXCHANGE) == 0:
+            return
+    tmp = path1 + '.tmp'
+    os.rename(path1, tmp)
+    os.rename(path2, path1)
+    os.rename(tmp, path2)
+
+
+def place_file(src, dst, hardlink=False):
+    """Place a copy of file src at dst, without reading it into memory
+
+    Tries, in order: a hard link (if `hardlink` is True), a reflink
+    (copy-on-write clone, on filesystems that support it), and an
+    in-kernel copy with copy_file_range(), before falling back to a
+    regular copy.
+
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        if hasattr(os, 'copy_file_range'):
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+            if copied == size:
+                return
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def file_hash(path):
+    """Hex SHA-256 digest of file contents, read in blocks"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def data_hash(data):
+    """Hex SHA-256 digest of data"""
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,119 @@
+"""
+This file is part of xapers.
+
+Xapers is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+Xapers is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License
+along with xapers.  If not, see <https://www.gnu.org/licenses/>.
+
+Copyright 2012-2017
+Jameson Rollins <jrollins@finestructure.net>
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+##################################################
+
+def retry(func, exception, timeout, initial=0.05, maximum=1.0):
+    """Call func until it doesn't raise exception, or timeout expires.
+
+    Retries back off exponentially from `initial` to `maximum`
+    seconds, with some jitter so that competing processes don't retry
+    in lock step.  The last exception is raised if the timeout
+    expires.
+
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial
+    while True:
+        try:
+            return func()
+        except exception:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise
+        time.sleep(min(delay * random.uniform(0.5, 1.0), remaining))
+        delay = min(delay * 2, maximum)
+
+##################################################
+
+class WriteQueue():
+    """Spool of pending document mutations.
+
+    Mutations that could not be applied because the database was
+    locked are written as json entries into the spool directory
+    `path`, and applied in the order they were queued by the next
+    writer to open (or close) the database.  Each entry is a dict
+    with a list of 'docids' and lists of tags to 'add' and 'remove'.
+    Entries that can not be read are set aside as hidden '.bad'
+    files, with a warning.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, docids, add_tags=[], remove_tags=[]):
+        """Queue tag changes for documents."""
+        os.makedirs(self.path, exist_ok=True)
+        entry = {
+            'docids': list(docids),
+            'add': list(add_tags),
+            'remove': list(remove_tags),
+            }
+        # entries are named by queue time, so that they sort in
+        # order, and renamed into place so they are never seen
+        # partially written
+        name = '%020d-%d.json' % (time.time_ns(), os.getpid())
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def __iter__(self):
+        """Iterate over (path, entry) tuples of queued entries, in order."""
+        try:
+            names = sorted(os.listdir(self.path))
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                continue
+            except ValueError as e:
+                # set aside corrupt entries, rather than failing on
+                # every open of the database
+                bad = os.path.join(self.path, '.' + name + '.bad')
+                print("Warning: skipping unreadable queue entry %s (%s), moved to %s."
+                      % (path, e, bad), file=sys.stderr)
+                try:
+                    os.replace(path, bad)
+                except FileNotFoundError:
+                    pass
+                continue
+            yield path, entry
+
+    def remove(self, path):
+        """Remove applied entry."""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass